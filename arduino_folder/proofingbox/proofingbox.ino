@@ -1,5 +1,5 @@
 /* Proofing Box Temperature controller using
- *  DS18S20 Temperature Sensor
+ *  DS18S20, DS18B20 or DS1822 Temperature Sensor
  *  HW-482 relay module
  *
  * Jabez McClelland jabezmcc1@yahoo.com
@@ -7,6 +7,127 @@
     
 */
 #include <OneWire.h>
+#include <EEPROM.h>
+
+// Readings go to the host as binary frames:
+//   0xA5, type, length, payload[length], crc8(type, length, payload)
+// where crc8 is the same Dallas CRC the OneWire library uses.  A sample
+// frame (type 'T') carries a sequence number, the raw 16-bit reading from
+// the sensor scratchpad (little endian), the relay state, the millis()
+// time the reading was taken (32 bit, little endian), the sensor's family
+// code with its COUNT_REMAIN and COUNT_PER_C scratchpad bytes, and the
+// sensor's channel number, so the host does the conversion (to 1/16 C
+// even from a DS18S20's 1/2 C reading), can tell when frames have been
+// dropped, and can time the reading to the millisecond however late the
+// frame is read.  Each time the relay switches, a relay frame (type 'R':
+// new state, then the millis() time of the switch) goes out at once, so
+// the host can work out the lamp's duty cycle and energy exactly.
+// Set BINARY_FRAMES to 0 to get plain text for the Serial Monitor.
+//
+// Up to MAX_SENSORS sensors can share the bus (air, dough, ambient...).
+// Each keeps the channel it was first found on for as long as the sketch
+// runs, answering or not, so one dropping out doesn't renumber the rest.
+// Channel 0 is the control sensor, the one that runs the lamp.  Its ROM
+// is kept in EEPROM (the first sensor ever found, until another is
+// chosen), so after a reset it is channel 0 again and the others follow
+// in bus search order.  While it isn't answering the lamp stays off; no
+// other sensor takes over by itself, except at power-up when it is
+// missing and exactly one other sensor is there (a replaced probe).
+//   CONTROL 2   make the sensor on channel 2 the control sensor (it
+//               swaps channels with the old one), saved in EEPROM
+// One conversion command goes to all of them at once (skip ROM), then
+// each is read and sent as its own sample frame, so more sensors don't
+// mean fewer readings.
+//
+// A reading only counts if the scratchpad's CRC checks out; a garbled
+// read (noise on a long sensor lead) is read again, up to READ_TRIES
+// times, before the channel gives up until the next conversion.  85.00 C
+// is what a sensor holds after power-on, before it has converted (a
+// brownout on its supply), so that reading is thrown away too.  Neither
+// ever reaches the relay or the host.  The sensor's counts of bad CRCs,
+// power-on readings and readings given up on since the Arduino started
+// go out in an error frame (type 'E': channel, then the three counts,
+// 16 bit each) whenever one of them goes up.
+//
+// loop() never waits on the sensors.  Their ROMs are found at start (and
+// again every SEARCH_INTERVAL while one is missing), a conversion is
+// started, and each pass polls for it to finish, reads them and starts
+// the next, so readings come as fast as the sensors convert (~750 ms) and
+// commands are answered, and the relay timed, within a pass of loop()
+// meanwhile.
+//
+// The sensor's family code (the first ROM byte) says how to read it: a
+// DS18S20 (0x10) always converts in 750 ms; a DS18B20 (0x28) or DS1822
+// (0x22) can be set to 9-12 bits, 0.5 C in 94 ms down to 1/16 C in 750 ms.
+//   RES         report the sensors
+//   RES 10      set the resolution in bits, saved in EEPROM
+// These are answered with a 'C' frame for each sensor: its channel, the
+// number of sensors, its ROM code (8 bytes, family code first), its
+// resolution in bits (0 for a DS18S20, whose resolution is fixed) and the
+// conversion time in ms (16 bit), then 1 if it is answering or 0 if it
+// has gone missing.  With no sensor there is one such frame, with 0
+// sensors.  The frames also answer CONTROL, and are sent whenever a
+// sensor is found or goes missing.
+//
+// The host can change the set point without reflashing by sending a line:
+//   SET 27.22   new set point in C, saved in EEPROM
+//   GET         report the set point
+//   ID          report this box's name
+//   ID dough1   rename the box (up to 8 characters), saved in EEPROM
+// SET and GET are answered with a set point frame ('S', set point and
+// margin in hundredths of a degree C, signed 16 bit), ID with an 'I' frame
+// holding the name.  Until a box is named it is called PB- plus the
+// serial number of its sensor, so boxes side by side on one computer can
+// always be told apart.  Anything else gets an empty 'N' frame.
+//
+// Control can be on/off (the lamp comes on below the set point minus half
+// the margin and goes off above it plus half the margin) or PID, where
+// the PID output is the fraction of each window of a few seconds the
+// lamp is on (time-proportioned), so it warms steadily instead of
+// overshooting.
+//   MODE ONOFF             on/off control (the default)
+//   MODE PID               PID control
+//   PID                    report the mode and PID settings
+//   PID kp ki kd window    set the gains (output fraction per C, per C.s,
+//                          per C/s) and the window (s), saved in EEPROM
+// These are answered with a 'P' frame: mode (0 on/off, 1 PID), then kp,
+// ki, kd as 32-bit floats and the window in seconds (16 bit).
+//
+// Temperatures are kept as whole hundredths of a degree (int) and text is
+// built in fixed char buffers, never with String, so the heap doesn't
+// fragment over weeks of uptime.  To check that it stays put:
+//   FREE        report the free RAM
+// answered with an 'F' frame: the bytes free between the heap and the
+// stack now, and the fewest there have been since power-up (16 bit each).
+#define BINARY_FRAMES 1
+#define FRAME_START 0xA5
+#define FRAME_SAMPLE 'T'
+#define FRAME_SETPOINT 'S'
+#define FRAME_NAK 'N'
+#define FRAME_ID 'I'
+#define FRAME_RELAY 'R'
+#define FRAME_PID 'P'
+#define FRAME_SENSOR 'C'
+#define FRAME_ERRORS 'E'
+#define FRAME_FREE 'F'
+#define MAX_PAYLOAD 16
+#define CMD_LEN 40
+#define ID_LEN 8
+#define TEMP_LEN 8             // "-327.68" and the terminating 0
+#define MODE_ONOFF 0
+#define MODE_PID 1
+#define SETTINGS_MAGIC 0x504A  // change whenever Settings changes
+#define FAMILY_DS18S20 0x10
+#define FAMILY_DS18B20 0x28
+#define FAMILY_DS1822 0x22
+#define CONVERT_SLACK 250      // ms past the data sheet conversion time we wait
+#define MAX_SENSORS 4
+#define SEARCH_INTERVAL 1000   // ms between looks for a missing sensor
+#define READ_TRIES 3           // reads of a garbled scratchpad before giving up
+#define POWER_ON_C100 8500     // the scratchpad's 85 C power-on value
+#define READ_OK 0
+#define READ_BAD 1             // answered, but garbled every try
+#define READ_GONE 2            // never answered
 int tempinPin=11; // define D11 as input pin connecting to DS18S20 S pin
 int pwrPin=12; //Use pin 12 as power for the DS18S20.
 int relayPin=8; // Use pin 8 for relay control
@@ -22,6 +143,50 @@ OneWire ds(tempinPin);
 // float setPoint = (setPoint_F-32.0)*5.0/9.0;
 float setPoint = 27.22;
 float marginC = 0.5;
+byte relayOn = 0;
+byte seqNo = 0;
+float flashedSetPoint;
+char cmdBuf[CMD_LEN];
+byte cmdLen = 0;
+char boxId[ID_LEN + 1] = "";
+byte sensorAddr[MAX_SENSORS][8];  // ROMs of the sensors, by channel
+byte nSensors = 0;  // channels in use, answering or not
+bool sensorFound[MAX_SENSORS];  // by channel: answering
+byte controlRom[8];  // the control sensor's ROM, 0s until there is one
+unsigned int crcErrors[MAX_SENSORS];     // by channel, since power-up
+unsigned int powerOnErrors[MAX_SENSORS];
+unsigned int missedReadings[MAX_SENSORS];
+unsigned int lowestFree = 0xFFFF;  // bytes, since power-up
+bool converting = false;
+byte resolution = 12;  // bits, for the sensors that can be set
+bool configPending = false;  // resolution to be written to the sensor
+unsigned long convertStart = 0;
+unsigned long lastSearch = 0;
+byte controlMode = MODE_ONOFF;
+float Kp = 0.5;     // lamp fully on 2 C below the set point
+float Ki = 0.002;   // ~4 min integral time
+float Kd = 0.;
+unsigned int windowSec = 20;
+float pidOut = 0.;  // fraction of the window the lamp is on
+float integral = 0.;
+float lastTemp = 0.;
+bool pidPrimed = false;
+unsigned long lastPid = 0;
+unsigned long windowStart = 0;
+
+// Saved in EEPROM.  flashedSetPoint remembers the setPoint value compiled
+// into the sketch, so reflashing with a new default still takes effect.
+struct Settings {
+  unsigned int magic;
+  float flashedSetPoint;
+  float setPoint;
+  char boxId[ID_LEN + 1];
+  byte controlMode;
+  float Kp, Ki, Kd;
+  unsigned int windowSec;
+  byte resolution;
+  byte controlRom[8];
+};
 
 void setup(void) {
   pinMode(relayPin, OUTPUT);
@@ -36,69 +201,802 @@ void setup(void) {
   digitalWrite(onLEDPin, LOW);
    
   Serial.begin(9600);
+  loadSettings();
+  if (controlRom[0] != 0)
+  {
+    memcpy(sensorAddr[0], controlRom, 8);  // channel 0, found or not
+    nSensors = 1;
+  }
+  findSensors();
+  if (nSensors == 2 && !sensorFound[0])
+  {
+    // the saved control sensor is gone and one other is here, most likely
+    // a replaced probe: it takes over, so the box isn't left cold
+    useControl(1);
+    nSensors = 1;
+    sendSensors();
+  }
+}
+
+void loadSettings() {
+  Settings settings;
+  EEPROM.get(0, settings);
+  flashedSetPoint = setPoint;
+  if (settings.magic != SETTINGS_MAGIC)
+  {
+    saveSettings();
+    return;
+  }
+  settings.boxId[ID_LEN] = 0;
+  strcpy(boxId, settings.boxId);
+  controlMode = settings.controlMode;
+  Kp = settings.Kp;
+  Ki = settings.Ki;
+  Kd = settings.Kd;
+  windowSec = settings.windowSec;
+  resolution = settings.resolution;
+  memcpy(controlRom, settings.controlRom, 8);
+  if (settings.flashedSetPoint == flashedSetPoint)
+  {
+    setPoint = settings.setPoint;
+  }
+  else
+  {
+    saveSettings();  // the new default, with everything else kept
+  }
+}
+
+void saveSettings() {
+  Settings settings;
+  settings.magic = SETTINGS_MAGIC;
+  settings.flashedSetPoint = flashedSetPoint;
+  settings.setPoint = setPoint;
+  strcpy(settings.boxId, boxId);
+  settings.controlMode = controlMode;
+  settings.Kp = Kp;
+  settings.Ki = Ki;
+  settings.Kd = Kd;
+  settings.windowSec = windowSec;
+  settings.resolution = resolution;
+  memcpy(settings.controlRom, controlRom, 8);
+  EEPROM.put(0, settings);
+}
+
+// Bytes free between the top of the heap and the stack
+extern int __heap_start, *__brkval;
+unsigned int freeRam() {
+  char top;
+  return &top - (__brkval ? (char *)__brkval : (char *)&__heap_start);
+}
+
+// Called where the stack is deepest (sending a frame from a command or
+// a reading), so lowestFree is close to the real low-water mark
+void checkFree() {
+  unsigned int bytes = freeRam();
+  if (bytes < lowestFree)
+  {
+    lowestFree = bytes;
+  }
+}
+
+void sendFree() {
+  unsigned int bytes = freeRam();
+  byte payload[4];
+  checkFree();
+  if (!BINARY_FRAMES)
+  {
+    Serial.print("FREE ");
+    Serial.print(bytes);
+    Serial.print(" ");
+    Serial.print(lowestFree);
+    Serial.print("\n");
+    return;
+  }
+  payload[0] = bytes & 0xff;
+  payload[1] = bytes >> 8;
+  payload[2] = lowestFree & 0xff;
+  payload[3] = lowestFree >> 8;
+  sendFrame(FRAME_FREE, payload, 4);
+}
+
+void sendFrame(byte type, const byte *payload, byte len) {
+  byte frame[MAX_PAYLOAD + 4];
+  byte i;
+  checkFree();
+  frame[0] = FRAME_START;
+  frame[1] = type;
+  frame[2] = len;
+  for (i = 0; i < len; i++) {
+    frame[3 + i] = payload[i];
+  }
+  frame[3 + len] = OneWire::crc8(frame + 1, len + 2);
+  Serial.write(frame, len + 4);
+}
+
+void sendSample(byte channel, const byte *data, unsigned long takenAt) {
+  byte payload[12];
+  payload[0] = seqNo++;
+  payload[1] = data[0];
+  payload[2] = data[1];
+  payload[3] = relayOn;
+  for (byte i = 0; i < 4; i++) {
+    payload[4 + i] = (takenAt >> (8 * i)) & 0xFF;
+  }
+  payload[8] = sensorAddr[channel][0];
+  payload[9] = data[6];
+  payload[10] = data[7];
+  payload[11] = channel;
+  sendFrame(FRAME_SAMPLE, payload, 12);
+}
+
+// Temperature in hundredths of a degree C from the scratchpad.  A DS18S20
+// (family 0x10) reads in 1/2 C, but counts how far through the last
+// degree it got: T = reading - 0.25 + (COUNT_PER_C - COUNT_REMAIN)/COUNT_PER_C.
+// The others read in 1/16 C.
+int centidegrees(byte family, const byte *data) {
+  int16_t raw = (data[1] << 8) | data[0];
+  if (family == FAMILY_DS18S20 && data[7] != 0)
+  {
+    return (raw >> 1) * 100 - 25 + (data[7] - data[6]) * 100 / data[7];
+  }
+  return (long)raw * 25 / 4;
+}
+
+// Hundredths of a degree as text, "-3.06", into buf (TEMP_LEN chars)
+void formatCentidegrees(char *buf, int c100) {
+  unsigned int magnitude = c100 < 0 ? -c100 : c100;
+  if (c100 < 0)
+  {
+    *buf++ = '-';
+  }
+  utoa(magnitude / 100, buf, 10);
+  buf += strlen(buf);
+  *buf++ = '.';
+  *buf++ = '0' + magnitude % 100 / 10;
+  *buf++ = '0' + magnitude % 10;
+  *buf = 0;
+}
+
+int hundredths(float value) {
+  return (int)(value * 100. + 0.5);
+}
+
+void setRelay(byte on) {
+  digitalWrite(relayPin, on ? HIGH : LOW);
+  digitalWrite(onLEDPin, on ? HIGH : LOW);
+  if (on == relayOn) {
+    return;
+  }
+  relayOn = on;
+  if (BINARY_FRAMES)
+  {
+    unsigned long now = millis();
+    byte payload[5];
+    payload[0] = on;
+    for (byte i = 0; i < 4; i++) {
+      payload[1 + i] = (now >> (8 * i)) & 0xFF;
+    }
+    sendFrame(FRAME_RELAY, payload, 5);
+  }
+}
+
+void sendSetpoint() {
+  int sp_100 = hundredths(setPoint);
+  int margin_100 = hundredths(marginC);
+  byte payload[4];
+  if (!BINARY_FRAMES)
+  {
+    Serial.print("SETPOINT ");
+    Serial.print(setPoint);
+    Serial.print("\n");
+    return;
+  }
+  payload[0] = sp_100 & 0xff;
+  payload[1] = sp_100 >> 8;
+  payload[2] = margin_100 & 0xff;
+  payload[3] = margin_100 >> 8;
+  sendFrame(FRAME_SETPOINT, payload, 4);
+}
+
+void putFloat(byte *p, float value) {
+  memcpy(p, &value, 4);  // AVR floats are IEEE single, little endian
+}
+
+void sendPid() {
+  byte payload[15];
+  if (!BINARY_FRAMES)
+  {
+    Serial.print(controlMode == MODE_PID ? "PID " : "ONOFF ");
+    Serial.print(Kp, 4);
+    Serial.print(" ");
+    Serial.print(Ki, 5);
+    Serial.print(" ");
+    Serial.print(Kd, 4);
+    Serial.print(" ");
+    Serial.print(windowSec);
+    Serial.print("\n");
+    return;
+  }
+  payload[0] = controlMode;
+  putFloat(payload + 1, Kp);
+  putFloat(payload + 5, Ki);
+  putFloat(payload + 9, Kd);
+  payload[13] = windowSec & 0xff;
+  payload[14] = windowSec >> 8;
+  sendFrame(FRAME_PID, payload, 15);
+}
+
+void resetPid() {
+  pidPrimed = false;
+  integral = 0.;
+  windowStart = millis();
+}
+
+// New PID output from a reading.  The integral is clamped to the output
+// range so it can't wind up while the lamp can't keep up, and the
+// derivative is taken on the temperature rather than the error, so a
+// set point change doesn't kick the output.
+void updatePid(float tempC, unsigned long now) {
+  float error = setPoint - tempC;
+  float out = Kp * error;
+  if (pidPrimed && now != lastPid)
+  {
+    float dt = (now - lastPid) / 1000.;
+    integral = constrain(integral + Ki * error * dt, 0., 1.);
+    out += integral - Kd * (tempC - lastTemp) / dt;
+  }
+  pidOut = constrain(out, 0., 1.);
+  pidPrimed = true;
+  lastTemp = tempC;
+  lastPid = now;
+}
+
+// Lamp on for the first pidOut of each window
+byte pidRelay(unsigned long now) {
+  unsigned long windowMs = windowSec * 1000UL;
+  if (now - windowStart >= windowMs)
+  {
+    windowStart += windowMs * ((now - windowStart) / windowMs);
+  }
+  return (now - windowStart) < pidOut * windowMs;
+}
+
+// Data sheet conversion time in ms, of the slowest sensor
+unsigned int conversionTime() {
+  for (byte ch = 0; ch < nSensors; ch++)
+  {
+    if (sensorAddr[ch][0] == FAMILY_DS18S20)
+    {
+      return 750;
+    }
+  }
+  return 750 >> (12 - resolution);
+}
+
+void sendSensor(byte channel) {
+  byte payload[14];
+  unsigned int ms = conversionTime();
+  byte bits = 0;
+  if (channel < nSensors && sensorAddr[channel][0] != FAMILY_DS18S20)
+  {
+    bits = resolution;
+  }
+  payload[0] = channel;
+  payload[1] = nSensors;
+  for (byte i = 0; i < 8; i++) {
+    payload[2 + i] = channel < nSensors ? sensorAddr[channel][i] : 0;
+  }
+  payload[10] = bits;
+  payload[11] = ms & 0xff;
+  payload[12] = ms >> 8;
+  payload[13] = channel < nSensors && sensorFound[channel];
+  if (!BINARY_FRAMES)
+  {
+    for (byte i = 2; i < 10; i++) {
+      Serial.print(payload[i], HEX);
+      Serial.print(" ");
+    }
+    Serial.print(bits);
+    Serial.print(" ");
+    Serial.print(ms);
+    Serial.print(payload[13] ? "\n" : " missing\n");
+    return;
+  }
+  sendFrame(FRAME_SENSOR, payload, 14);
+}
+
+void sendErrors(byte channel) {
+  byte payload[7];
+  payload[0] = channel;
+  payload[1] = crcErrors[channel] & 0xff;
+  payload[2] = crcErrors[channel] >> 8;
+  payload[3] = powerOnErrors[channel] & 0xff;
+  payload[4] = powerOnErrors[channel] >> 8;
+  payload[5] = missedReadings[channel] & 0xff;
+  payload[6] = missedReadings[channel] >> 8;
+  if (!BINARY_FRAMES)
+  {
+    Serial.print("sensor ");
+    Serial.print(channel);
+    Serial.print(": ");
+    Serial.print(crcErrors[channel]);
+    Serial.print(" bad CRC, ");
+    Serial.print(powerOnErrors[channel]);
+    Serial.print(" at 85 C, ");
+    Serial.print(missedReadings[channel]);
+    Serial.print(" missed\n");
+    return;
+  }
+  sendFrame(FRAME_ERRORS, payload, 7);
+}
+
+void sendSensors() {
+  byte ch = 0;
+  do {
+    sendSensor(ch++);
+  } while (ch < nSensors);
+}
+
+void sendId() {
+  char id[ID_LEN + 1];
+  const char hex[] = "0123456789ABCDEF";
+  if (boxId[0])
+  {
+    strcpy(id, boxId);
+  }
+  else
+  {
+    // control sensor serial number bytes 1 and 2 (byte 0 is the family code)
+    strcpy(id, "PB-");
+    id[3] = hex[sensorAddr[0][2] >> 4];
+    id[4] = hex[sensorAddr[0][2] & 0xf];
+    id[5] = hex[sensorAddr[0][1] >> 4];
+    id[6] = hex[sensorAddr[0][1] & 0xf];
+    id[7] = 0;
+  }
+  if (!BINARY_FRAMES)
+  {
+    Serial.print("ID ");
+    Serial.print(id);
+    Serial.print("\n");
+    return;
+  }
+  sendFrame(FRAME_ID, (byte *)id, strlen(id));
+}
+
+void handleCommand(char *cmd) {
+  float value;
+  if (strncmp(cmd, "SET ", 4) == 0)
+  {
+    value = atof(cmd + 4);
+    if (value > 0. && value < 60.)
+    {
+      setPoint = value;
+      saveSettings();
+    }
+    sendSetpoint();
+  }
+  else if (strcmp(cmd, "GET") == 0)
+  {
+    sendSetpoint();
+  }
+  else if (strcmp(cmd, "FREE") == 0)
+  {
+    sendFree();
+  }
+  else if (strncmp(cmd, "ID", 2) == 0 && (cmd[2] == 0 || cmd[2] == ' '))
+  {
+    if (cmd[2] == ' ' && strlen(cmd + 3) <= ID_LEN)
+    {
+      strcpy(boxId, cmd + 3);
+      saveSettings();
+    }
+    sendId();
+  }
+  else if (strncmp(cmd, "PID", 3) == 0 && (cmd[3] == 0 || cmd[3] == ' '))
+  {
+    if (cmd[3] == ' ')
+    {
+      char *p = cmd + 4;
+      float kp = strtod(p, &p);
+      float ki = strtod(p, &p);
+      float kd = strtod(p, &p);
+      float window = strtod(p, &p);
+      if (kp >= 0. && ki >= 0. && kd >= 0. && window >= 2. && window <= 600.)
+      {
+        Kp = kp;
+        Ki = ki;
+        Kd = kd;
+        windowSec = (unsigned int)(window + 0.5);
+        resetPid();
+        saveSettings();
+      }
+    }
+    sendPid();
+  }
+  else if (strncmp(cmd, "RES", 3) == 0 && (cmd[3] == 0 || cmd[3] == ' '))
+  {
+    if (cmd[3] == ' ')
+    {
+      int bits = atoi(cmd + 4);
+      if (bits >= 9 && bits <= 12 && bits != resolution)
+      {
+        resolution = bits;
+        configPending = true;
+        saveSettings();
+      }
+    }
+    sendSensors();
+  }
+  else if (strncmp(cmd, "CONTROL ", 8) == 0)
+  {
+    int channel = atoi(cmd + 8);
+    if (channel > 0 && channel < nSensors && sensorFound[channel])
+    {
+      useControl(channel);
+    }
+    sendSensors();
+  }
+  else if (strncmp(cmd, "MODE ", 5) == 0)
+  {
+    if (strcmp(cmd + 5, "PID") == 0 && controlMode != MODE_PID)
+    {
+      controlMode = MODE_PID;
+      resetPid();
+      saveSettings();
+    }
+    else if (strcmp(cmd + 5, "ONOFF") == 0 && controlMode != MODE_ONOFF)
+    {
+      controlMode = MODE_ONOFF;
+      saveSettings();
+    }
+    sendPid();
+  }
+  else if (BINARY_FRAMES)
+  {
+    sendFrame(FRAME_NAK, 0, 0);
+  }
+}
+
+// Collect command lines from the host without blocking
+void pollSerial() {
+  char c;
+  while (Serial.available() > 0)
+  {
+    c = Serial.read();
+    if (c == '\n' || c == '\r')
+    {
+      if (cmdLen > 0)
+      {
+        cmdBuf[cmdLen] = 0;
+        handleCommand(cmdBuf);
+        cmdLen = 0;
+      }
+    }
+    else if (cmdLen < CMD_LEN - 1)
+    {
+      cmdBuf[cmdLen++] = c;
+    }
+  }
 }
  
+bool knownFamily(byte family) {
+  return family == FAMILY_DS18S20 || family == FAMILY_DS18B20 || family == FAMILY_DS1822;
+}
+
+// The channel of the sensor with this ROM, or nSensors if it has none
+byte channelOf(const byte *rom) {
+  byte ch = 0;
+  while (ch < nSensors && memcmp(sensorAddr[ch], rom, 8) != 0)
+  {
+    ch++;
+  }
+  return ch;
+}
+
+// No reading from the control sensor: the lamp goes off rather than
+// heating blind, and PID starts afresh when it is back
+void controlLost() {
+  resetPid();
+  setRelay(0);
+}
+
+// Find the temperature sensors on the bus, passing over other OneWire
+// devices and garbled ROMs.  The ones we know keep their channels; new
+// ones get the next free channel.
+void findSensors() {
+  byte rom[8];
+  byte ch;
+  bool changed = false;
+  bool wasFound[MAX_SENSORS];
+  lastSearch = millis();
+  converting = false;
+  for (ch = 0; ch < nSensors; ch++)
+  {
+    wasFound[ch] = sensorFound[ch];
+    sensorFound[ch] = false;
+  }
+  ds.reset_search();
+  while (ds.search(rom))
+  {
+    if (OneWire::crc8(rom, 7) != rom[7] || !knownFamily(rom[0]))
+    {
+      continue;
+    }
+    ch = channelOf(rom);
+    if (ch == nSensors)
+    {
+      if (nSensors == MAX_SENSORS)
+      {
+        continue;
+      }
+      memcpy(sensorAddr[nSensors++], rom, 8);
+      wasFound[ch] = false;
+    }
+    sensorFound[ch] = true;
+  }
+  for (ch = 0; ch < nSensors; ch++)
+  {
+    changed |= sensorFound[ch] != wasFound[ch];
+  }
+  if (controlRom[0] == 0 && nSensors > 0)
+  {
+    memcpy(controlRom, sensorAddr[0], 8);  // the first sensor ever found
+    saveSettings();
+  }
+  if (nSensors > 0 && !sensorFound[0])
+  {
+    controlLost();
+  }
+  if (changed)
+  {
+    configPending = true;  // new, or back after a power glitch
+    sendSensors();
+  }
+}
+
+void swapCounts(unsigned int *counts, byte a, byte b) {
+  unsigned int count = counts[a];
+  counts[a] = counts[b];
+  counts[b] = count;
+}
+
+// Make the sensor on a channel the control sensor, swapping channels
+// (and error counts) with the old one
+void useControl(byte channel) {
+  byte rom[8];
+  bool found = sensorFound[0];
+  memcpy(rom, sensorAddr[0], 8);
+  memcpy(sensorAddr[0], sensorAddr[channel], 8);
+  memcpy(sensorAddr[channel], rom, 8);
+  sensorFound[0] = sensorFound[channel];
+  sensorFound[channel] = found;
+  swapCounts(crcErrors, 0, channel);
+  swapCounts(powerOnErrors, 0, channel);
+  swapCounts(missedReadings, 0, channel);
+  memcpy(controlRom, sensorAddr[0], 8);
+  saveSettings();
+  resetPid();
+}
+
+byte sensorsFound() {
+  byte found = 0;
+  for (byte ch = 0; ch < nSensors; ch++)
+  {
+    found += sensorFound[ch];
+  }
+  return found;
+}
+
+// Set the resolution of the DS18B20s/DS1822s (write scratchpad: alarm
+// bytes, then the configuration register, bits 5-6)
+void writeConfig() {
+  configPending = false;
+  for (byte ch = 0; ch < nSensors; ch++)
+  {
+    if (sensorAddr[ch][0] == FAMILY_DS18S20)
+    {
+      continue;
+    }
+    ds.reset();
+    ds.select(sensorAddr[ch]);
+    ds.write(0x4E);
+    ds.write(0x4B);
+    ds.write(0x46);
+    ds.write(((resolution - 9) << 5) | 0x1F);
+  }
+}
+
+// Start a conversion on every sensor at once; they have their own power
+// pin, so they don't need the strong pull-up and we can poll the bus for
+// completion (it reads 0 until the slowest is done)
+void startConversion() {
+  if (configPending)
+  {
+    writeConfig();
+  }
+  if (!ds.reset())
+  {
+    findSensors();  // nothing on the bus: they are all missing
+    return;
+  }
+  ds.skip();
+  ds.write(0x44);
+  convertStart = millis();
+  converting = true;
+}
+
+// Read one sensor's scratchpad, again if it doesn't answer or the CRC is
+// wrong: READ_OK, READ_BAD if it was garbled every time or READ_GONE if
+// it never answered.  All zeros (the bus held low) passes the CRC, so
+// it counts as garbled too.  All ones is the pull-up: nobody answered,
+// though the other sensors still give the bus its presence pulse.
+byte readScratchpad(byte channel, byte *data) {
+  byte result = READ_GONE;
+  byte any, all;
+  for (byte attempt = 0; attempt < READ_TRIES; attempt++)
+  {
+    if (!ds.reset())
+    {
+      continue;
+    }
+    ds.select(sensorAddr[channel]);
+    ds.write(0xBE);
+    any = 0;
+    all = 0xFF;
+    for (byte i = 0; i < 9; i++) {
+      data[i] = ds.read();
+      any |= data[i];
+      all &= data[i];
+    }
+    if (all == 0xFF)
+    {
+      continue;
+    }
+    if (any != 0 && OneWire::crc8(data, 8) == data[8])
+    {
+      if (sensorAddr[channel][0] != FAMILY_DS18S20)
+      {
+        data[0] &= ~((1 << (12 - resolution)) - 1);  // undefined below the resolution
+      }
+      return READ_OK;
+    }
+    crcErrors[channel]++;
+    result = READ_BAD;
+  }
+  return result;
+}
+
 void loop(void) {
-  int HighByte, LowByte, TReading, SignBit, Tc_100, Whole, Fract;
-  byte i;
-  byte present = 0;
+  pollSerial();
+  if (controlMode == MODE_PID && pidPrimed)
+  {
+    setRelay(pidRelay(millis()));  // time the window to the millisecond
+  }
+  if (!converting)
+  {
+    byte found = sensorsFound();
+    if ((found < nSensors || nSensors == 0) && millis() - lastSearch >= SEARCH_INTERVAL)
+    {
+      findSensors();  // look for the missing
+    }
+    else if (found > 0)
+    {
+      startConversion();
+    }
+    return;
+  }
+  if (!ds.read_bit() && millis() - convertStart < conversionTime() + CONVERT_SLACK)
+  {
+    return;  // still converting
+  }
+  converting = false;
+  readSensors();
+}
+
+// Read the finished conversion from every sensor, switch the relay on
+// channel 0's reading and report them all.  A sensor that is missing, or
+// whose reading can't be trusted, is left out of this round (-- in text).
+void readSensors() {
+  int Tc_100;
   byte data[12];
-  byte addr[8];
-  String tempstr = "";
- 
-  if ( !ds.search(addr)) {
-      ds.reset_search();
-      return;
-  }
-  // Retrieve temperature reading and write to serial port
-  ds.reset();
-  ds.select(addr);
-  ds.write(0x44,1); 
-  delay(1000); //Check temp once per second 
-  present = ds.reset();
-  ds.select(addr);    
-  ds.write(0xBE);  
-  for ( i = 0; i < 9; i++) { 
-    data[i] = ds.read();
-  }
-  LowByte = data[0];
-  HighByte = data[1];
-  TReading = (HighByte << 8) + LowByte;
-  SignBit = TReading & 0x8000;  
-  if (SignBit)
-  {
-    TReading = (TReading ^ 0xffff) + 1;
-  }
-  Tc_100 = (6 * TReading) + TReading / 4; 
-  Whole = Tc_100 / 100; 
-  Fract = Tc_100 % 100;
-  if (SignBit)
-  {
-     Serial.print("-");
-     tempstr += "-";
-  }
-  Serial.print(Whole);
-  tempstr += String(Whole);
-  Serial.print(".");
-  tempstr +=".";
-  if (Fract < 10)
-  {
-     Serial.print("0");
-     tempstr += "0";
-  }
-  Serial.print(Fract);
-  tempstr += String(Fract);
-  Serial.print("\n");
-  
-  // Compare temp to setpoint and switch relay accordingly
-  if (tempstr.toFloat() <= setPoint - marginC/2.)
-  {
-    digitalWrite(relayPin, HIGH);
-    digitalWrite(onLEDPin, HIGH);
-  }
-  if (tempstr.toFloat() > setPoint + marginC/2.)
-  {
-    digitalWrite(relayPin, LOW);
-    digitalWrite(onLEDPin, LOW);
+  byte result;
+  byte errorsUp = 0;  // bit per channel whose error counts went up
+  byte gone = 0;      // bit per channel that stopped answering
+  unsigned int crcBefore;
+  char tempstr[TEMP_LEN];
+  // lamp on at or below the set point less half the margin, off above it
+  // plus half the margin
+  int sp_100 = hundredths(setPoint);
+  int halfMargin_100 = hundredths(marginC) / 2;
+  // they all converted together, when the bus says they finished
+  unsigned long takenAt = millis();
+
+  for (byte ch = 0; ch < nSensors; ch++)
+  {
+    crcBefore = crcErrors[ch];
+    result = sensorFound[ch] ? readScratchpad(ch, data) : READ_GONE;
+    if (result == READ_GONE && sensorFound[ch])
+    {
+      sensorFound[ch] = false;  // looked for again in loop()
+      gone |= 1 << ch;
+      if (ch == 0)
+      {
+        controlLost();
+      }
+    }
+    if (result == READ_OK && centidegrees(sensorAddr[ch][0], data) == POWER_ON_C100)
+    {
+      // a brownout also put a DS18B20 back to 12 bits: write the
+      // resolution again before the next conversion
+      powerOnErrors[ch]++;
+      configPending = true;
+      result = READ_BAD;
+    }
+    if (result == READ_BAD)
+    {
+      missedReadings[ch]++;
+    }
+    if (crcErrors[ch] != crcBefore || result == READ_BAD)
+    {
+      errorsUp |= 1 << ch;
+    }
+    if (result != READ_OK)
+    {
+      if (!BINARY_FRAMES)
+      {
+        Serial.print(ch > 0 ? "\t--" : "--");
+      }
+      continue;
+    }
+    Tc_100 = centidegrees(sensorAddr[ch][0], data);
+
+    // Compare temp to setpoint and switch relay accordingly
+    if (ch == 0 && controlMode == MODE_PID)
+    {
+      updatePid(Tc_100 / 100., takenAt);
+      setRelay(pidRelay(takenAt));
+    }
+    else if (ch == 0)
+    {
+      if (Tc_100 <= sp_100 - halfMargin_100)
+      {
+        setRelay(1);
+      }
+      if (Tc_100 > sp_100 + halfMargin_100)
+      {
+        setRelay(0);
+      }
+    }
+
+    // Report the reading; in text, all the channels on one line
+    if (BINARY_FRAMES)
+    {
+      sendSample(ch, data, takenAt);
+    }
+    else
+    {
+      if (ch > 0)
+      {
+        Serial.print("\t");
+      }
+      formatCentidegrees(tempstr, Tc_100);
+      Serial.print(tempstr);
+    }
+  }
+  if (!BINARY_FRAMES)
+  {
+    Serial.print("\n");
+  }
+  for (byte ch = 0; ch < nSensors; ch++)
+  {
+    if (errorsUp & (1 << ch))
+    {
+      sendErrors(ch);
+    }
+    if (gone & (1 << ch))
+    {
+      sendSensor(ch);
+    }
   }
 }
@@ -0,0 +1,76 @@
+# bench_startup - import-time budget for prooferator.py
+# (c) 2022, 2024 - Jabez McClelland jabezmcc@gmail.com
+#
+# Runs "python -X importtime -c 'import prooferator'" in a fresh interpreter
+# and fails (exit status 1) if the import takes longer than the budget or
+# pulls in one of the heavy modules the welcome window doesn't need.
+#
+# Usage: python bench_startup.py [budget in ms] [runs]
+#
+# The default budget is for a desktop machine; on the kitchen Raspberry Pi
+# pass a bigger one.  The best of several runs is used, to keep disk cache
+# effects out of it.
+#
+import pathlib
+import subprocess
+import sys
+
+BUDGET_MS = 250.
+RUNS = 3
+DEFERRED = ('matplotlib', 'numpy', 'xlsxwriter', 'proofdata', 'prooflog', 'liveplot')
+
+
+def import_times():
+    # (total ms for "import prooferator", {module prooferator imports
+    # directly: cumulative ms}, {every package imported}) for one fresh
+    # import.  -X importtime lists children before their parent, indented
+    # two spaces per level.
+    srcdir = pathlib.Path(__file__).parent.resolve()
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import prooferator'],
+                            cwd=srcdir, capture_output=True, text=True)
+    if result.returncode:
+        sys.exit(result.stderr)
+    children = {}
+    packages = set()
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        fields = line[len('import time:'):].split('|')
+        name = fields[2].rstrip()[1:]
+        depth = (len(name) - len(name.lstrip()))//2
+        name = name.strip()
+        ms = int(fields[1])/1000.
+        packages.add(name.split('.')[0])
+        if depth == 1:
+            children[name] = ms
+        elif depth == 0:
+            if name == 'prooferator':
+                return ms, children, packages
+            children = {}
+    sys.exit('prooferator not found in -X importtime output')
+
+
+def main(argv):
+    budget = float(argv[1]) if len(argv) > 1 else BUDGET_MS
+    runs = int(argv[2]) if len(argv) > 2 else RUNS
+    best = None
+    for i in range(runs):
+        run = import_times()
+        if best is None or run[0] < best[0]:
+            best = run
+    total, children, packages = best
+    print('import prooferator: {:.1f} ms (budget {:.0f} ms)'.format(total, budget))
+    for name, ms in sorted(children.items(), key=lambda item: -item[1])[:10]:
+        print('  {:8.1f} ms  {}'.format(ms, name))
+    ok = total <= budget
+    early = [name for name in DEFERRED if name in packages]
+    if early:
+        print('Imported at startup but should be deferred:', ', '.join(early))
+        ok = False
+    if not ok:
+        print('FAILED')
+    return 0 if ok else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,924 @@
+# boxlink - serial connection to the proofing box Arduino
+# (c) 2022, 2024 - Jabez McClelland jabezmcc@gmail.com
+#
+# Opening the serial port pulses DTR, which resets the Arduino, so every
+# open costs ~2 s of bootloader time before the first reading shows up.
+# BoxLink opens the port once, keeps it open for the life of the program,
+# and has a reader thread that keeps the latest reading on hand.  If the
+# Arduino is unplugged the thread keeps trying to reopen the port.
+#
+# The firmware sends binary frames (see proofingbox.ino):
+#   0xA5, type, length, payload[length], crc8(type, length, payload)
+# FrameParser pulls them out of the byte stream.  Anything between frames is
+# collected as text lines, so a board still running the old text-only sketch
+# keeps working until it is reflashed.
+#
+# Commands go the other way as text lines ('SET 27.22', 'GET', 'ID',
+# 'MODE PID', 'PID 0.5 0.002 0 20', 'RES 10'); the firmware answers each
+# with one frame, or an 'N' frame for anything it doesn't understand.
+#
+# A box can have several sensors (air, dough, ...), each a channel of its
+# own: sample frames carry the channel number, and the sensor frames
+# ('C') say which sensor (ROM code) each channel is.  Channel 0 controls
+# the lamp and goes by the box's name; the others are named in
+# sensors.json by ROM code (see stream_name()).
+#
+# Several boxes can be plugged in at once: discover_boxes() opens every
+# likely-looking serial port and keeps those with a proofing box on them.
+# Each BoxLink has its own reader thread, so one slow or unplugged box
+# never holds up the others.  boxloop.py does the same on an asyncio event
+# loop instead, for the daemon; BoxState is the part the two share.
+#
+import collections
+import concurrent.futures
+import contextlib
+import datetime as dt
+import json
+import os
+import struct
+import threading
+import time
+
+import serial
+
+PORT = '/dev/ttyACM0'
+BAUD = 9600
+RETRY_INTERVAL = 2.0    # seconds between attempts to reopen the port
+FIRST_READING_WAIT = 4.0  # bootloader (~2 s) plus one conversion, with margin
+REPLY_WAIT = 3.0          # older sketches only look at commands once per reading
+# shortest sampling interval (s) with a 12-bit DS18B20, or a sensor we
+# know nothing about: one conversion.  Sampling faster than the firmware
+# sends readings just skips the repeats.
+MIN_INTERVAL = 0.75
+FASTEST_INTERVAL = 0.094  # a 9-bit conversion, the fastest any box reads
+SETPOINT_RANGE = (0., 60.)  # set points (C) the firmware will accept
+# USB vendor IDs of Arduinos and the usual USB-serial chips on clones
+ARDUINO_VIDS = {0x2341, 0x2a03, 0x1a86, 0x0403, 0x10c4}
+
+FRAME_START = 0xA5
+FRAME_SAMPLE = ord('T')
+FRAME_SETPOINT = ord('S')
+FRAME_NAK = ord('N')
+FRAME_ID = ord('I')
+FRAME_RELAY = ord('R')
+FRAME_PID = ord('P')
+FRAME_SENSOR = ord('C')
+FRAME_ERRORS = ord('E')
+FRAME_FREE = ord('F')
+# the frame that answers each command, by its first word (anything else
+# gets FRAME_NAK).  The firmware also sends 'C' frames of its own when a
+# sensor comes or goes, so only a frame of the type asked for is a reply.
+REPLY_FRAMES = {'SET': FRAME_SETPOINT, 'GET': FRAME_SETPOINT, 'ID': FRAME_ID, 'MODE': FRAME_PID,
+                'PID': FRAME_PID, 'RES': FRAME_SENSOR, 'CONTROL': FRAME_SENSOR, 'FREE': FRAME_FREE}
+MAX_PAYLOAD = 16
+FAMILY_DS18S20 = 0x10  # reads in 1/2 C, with COUNT_REMAIN for the fraction
+SENSOR_FAMILIES = {FAMILY_DS18S20: 'DS18S20', 0x28: 'DS18B20', 0x22: 'DS1822'}
+RESOLUTIONS = range(9, 13)  # bits a DS18B20 or DS1822 can be set to
+# names for the sensors of multi-sensor boxes, {ROM code: name}
+SENSOR_NAMES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sensors.json')
+MAX_TEXT = 64  # longest text line we'll hold on to
+CLOCK_WINDOW = 64  # sample frames the device clock offset is estimated over
+MAX_SWITCHES = 10000  # relay switches kept per box for plotting
+LAMP_WATTS = 15.      # the proofing box's bulb
+CONTROL_MODES = ('onoff', 'pid')  # by the firmware's mode number
+
+
+def _crc8_table():
+    # Dallas/Maxim CRC-8, as computed by OneWire::crc8 on the Arduino
+    table = []
+    for byte in range(256):
+        crc = byte
+        for bit in range(8):
+            crc = (crc >> 1) ^ 0x8C if crc & 1 else crc >> 1
+        table.append(crc)
+    return table
+
+CRC8_TABLE = _crc8_table()
+
+
+def crc8(data):
+    crc = 0
+    for byte in data:
+        crc = CRC8_TABLE[crc ^ byte]
+    return crc
+
+
+class FrameParser:
+    # Feed it bytes as they arrive; feed() returns a list of ('frame', type,
+    # payload) and ('text', line) items.  A frame with a bad checksum costs
+    # only its start byte: we resync on the next 0xA5.
+    def __init__(self):
+        self.buf = bytearray()
+        self.text = bytearray()
+        self.badframes = 0
+
+    def feed(self, data):
+        self.buf += data
+        items = []
+        while self.buf:
+            if self.buf[0] != FRAME_START:
+                self._text_byte(self.buf.pop(0), items)
+                continue
+            if len(self.buf) < 3:
+                break
+            length = self.buf[2]
+            if length > MAX_PAYLOAD:
+                self.badframes += 1
+                del self.buf[0]
+                continue
+            if len(self.buf) < length + 4:
+                break
+            if crc8(self.buf[1:3 + length]) != self.buf[3 + length]:
+                self.badframes += 1
+                del self.buf[0]
+                continue
+            items.append(('frame', self.buf[1], bytes(self.buf[3:3 + length])))
+            del self.buf[:length + 4]
+        return items
+
+    def _text_byte(self, byte, items):
+        if byte == ord('\n'):
+            items.append(('text', self.text.decode('ascii', 'replace').strip()))
+            self.text.clear()
+        elif len(self.text) < MAX_TEXT:
+            self.text.append(byte)
+
+
+def sample_temperature(raw, family=None, count_remain=0, count_per_c=0):
+    # C from the signed scratchpad reading.  A DS18S20's is in 1/2 C, and
+    # COUNT_REMAIN/COUNT_PER_C say how far through the degree it got, which
+    # is good to about 1/16 C; the others' is in 1/16 C already.  Older
+    # sketches don't send the family, and always scaled by 1/16.
+    if family == FAMILY_DS18S20 and count_per_c:
+        return (raw >> 1) - 0.25 + (count_per_c - count_remain)/count_per_c
+    return raw/16.
+
+
+def decode_sample(payload):
+    # (sequence number, temperature in C, relay on, device millis() or
+    # None, channel) from a 'T' frame; sketches before the millis() field
+    # sent 4 bytes, before the family and counts 8, and before channels 11
+    if len(payload) == 4:
+        seq, raw, relay = struct.unpack('<BhB', payload)
+        return seq, sample_temperature(raw), bool(relay), None, 0
+    if len(payload) == 8:
+        seq, raw, relay, millis = struct.unpack('<BhBI', payload)
+        return seq, sample_temperature(raw), bool(relay), millis, 0
+    channel = payload[11] if len(payload) == 12 else 0
+    seq, raw, relay, millis, family, remain, per_c = struct.unpack('<BhBIBBB', payload[:11])
+    return seq, sample_temperature(raw, family, remain, per_c), bool(relay), millis, channel
+
+
+class DeviceClock:
+    # Maps the firmware's millis() to wall-clock time.  A frame arrives
+    # some variable but never negative delay after its reading was taken
+    # (serial transfer, the OS, our reader), so arrival minus device time is
+    # the clock offset plus that delay, and the smallest recent value is
+    # the best estimate of the offset.  Estimating over a window rather
+    # than all time lets it follow the board's resonator, which can be
+    # off by a few tenths of a percent.
+    def __init__(self, window=CLOCK_WINDOW):
+        self.offsets = collections.deque(maxlen=window)
+        self.last = None  # latest millis() seen
+        self.ms = 0       # the same, unwrapped (millis() wraps after 49.7 days)
+
+    def stamp(self, millis, arrived):
+        # wall-clock datetime the reading stamped `millis` was taken, given
+        # the time.time() its frame arrived
+        if self.last is not None:
+            step = (millis - self.last) % 2**32
+            if step >= 2**31:
+                self.offsets.clear()  # went backwards: the board was reset
+                self.ms = millis
+            else:
+                self.ms += step
+        else:
+            self.ms = millis
+        self.last = millis
+        self.offsets.append(arrived - self.ms/1000.)
+        return dt.datetime.fromtimestamp(self.ms/1000. + min(self.offsets))
+
+
+def decode_setpoint(payload):
+    # (set point, margin) in C from an 'S' frame
+    sp_100, margin_100 = struct.unpack('<hh', payload)
+    return sp_100/100., margin_100/100.
+
+
+def decode_relay(payload):
+    # (relay on, device millis()) from an 'R' frame
+    on, millis = struct.unpack('<BI', payload)
+    return bool(on), millis
+
+
+def decode_pid(payload):
+    # control settings from a 'P' frame: {'mode': 'onoff' or 'pid', 'kp',
+    # 'ki', 'kd' (lamp fraction per C, per C.s and per C/s), 'window' (s)}
+    mode, kp, ki, kd, window = struct.unpack('<BfffH', payload)
+    return {'mode': CONTROL_MODES[mode] if mode < len(CONTROL_MODES) else None,
+            'kp': kp, 'ki': ki, 'kd': kd, 'window': window}
+
+
+def decode_sensor(payload):
+    # (channel, number of sensors, sensor) from a 'C' frame, where sensor is
+    # {'rom': ROM code as '28-0000056a1b2c', 'family': name, 'resolution':
+    # bits (None if it can't be set), 'conversion': seconds per reading of
+    # all the box's sensors, 'found': False while it isn't answering}.
+    # Earlier sketches sent 4 bytes (one sensor) or 13 (no 'found').
+    found = True
+    if len(payload) == 4:
+        family, bits, ms = struct.unpack('<BBH', payload)
+        rom = None
+        channel, count = 0, 1
+    else:
+        channel, count, rom, bits, ms = struct.unpack('<BB8sBH', payload[:13])
+        family = rom[0]
+        rom = '{:02x}-{}'.format(family, rom[6:0:-1].hex())
+        if len(payload) == 14:
+            found = bool(payload[13])
+    return channel, count, {'rom': rom, 'family': SENSOR_FAMILIES.get(family, '0x{:02X}'.format(family)),
+                            'resolution': bits or None, 'conversion': ms/1000., 'found': found}
+
+
+def decode_errors(payload):
+    # (channel, counts) from an 'E' frame: the sensor's bad CRCs, 85 C
+    # power-on readings and readings missed because of either, since the
+    # Arduino started
+    channel, crc, power_on, missed = struct.unpack('<BHHH', payload)
+    return channel, {'crc': crc, 'power_on': power_on, 'missed': missed}
+
+
+def decode_free(payload):
+    # the Arduino's free RAM from an 'F' frame: {'free': bytes now,
+    # 'lowest': fewest bytes free since it started}
+    free, lowest = struct.unpack('<HH', payload)
+    return {'free': free, 'lowest': lowest}
+
+
+def load_sensor_names():
+    try:
+        with open(SENSOR_NAMES) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def save_sensor_names(names):
+    with open(SENSOR_NAMES, 'w') as f:
+        json.dump(names, f, indent=1)
+
+
+def pid_command(kp, ki, kd, window):
+    return 'PID {:.6g} {:.6g} {:.6g} {:d}'.format(kp, ki, kd, int(round(window)))
+
+
+class RelayMeter:
+    # The lamp's duty cycle, cycle period (on to on) and energy since
+    # start(), from the relay's switching.  Kept as running sums, so stats()
+    # costs the same however long the proof.
+    def __init__(self, watts=LAMP_WATTS):
+        self.watts = watts
+        self.start(None, None)
+
+    def start(self, stamp, on):
+        self.since = stamp    # None until started
+        self.on = bool(on)
+        self.changed = stamp  # time of the latest switch (or the start)
+        self.on_time = dt.timedelta(0)
+        self.cycles = 0
+        self.first_on = None
+        self.last_on = None
+
+    def switch(self, stamp, on):
+        if self.since is None or on == self.on:
+            return
+        if self.on:
+            self.on_time += stamp - self.changed
+        else:
+            if self.last_on is not None:
+                self.cycles += 1
+            else:
+                self.first_on = stamp
+            self.last_on = stamp
+        self.on = on
+        self.changed = stamp
+
+    def stats(self, now):
+        # {'duty': 0-1, 'period': timedelta or None, 'energy_wh', 'cycles'}
+        # up to now, or None before start() or any time has passed
+        if self.since is None or now <= self.since:
+            return None
+        on_time = self.on_time + (now - self.changed if self.on else dt.timedelta(0))
+        return {'duty': on_time/(now - self.since),
+                'period': (self.last_on - self.first_on)/self.cycles if self.cycles else None,
+                'energy_wh': on_time.total_seconds()/3600.*self.watts,
+                'cycles': self.cycles}
+
+
+class BoxState:
+    # What we know about a box, kept up to date from what it sends.  feed()
+    # takes bytes from the port; subclasses do the reading and say how
+    # waiters are woken (notify()).
+    def __init__(self, port=PORT, baud=BAUD):
+        self.port = port
+        self.baud = baud
+        self.ser = None
+        self.temperature = None  # latest reading in C, None if we have none
+        self.relay = None        # lamp relay on/off as of the latest reading
+        self.stamp = None        # time.monotonic() of latest reading
+        self.taken = None        # wall-clock time the latest reading was taken
+        self.clock = DeviceClock()
+        self.switches = collections.deque(maxlen=MAX_SWITCHES)  # (time, relay on)
+        self.nswitches = 0       # relay switches ever seen
+        self.meter = RelayMeter()
+        self.parser = FrameParser()
+        self.seq = None          # sequence number of the latest sample frame
+        self.dropped = 0         # sample frames lost (gaps in the sequence)
+        self.setpoint = None     # as last reported by the firmware, in C
+        self.margin = None
+        self.control = None      # decode_pid() of the latest 'P' frame
+        self.sensors = []        # decode_sensor()s by channel, as last reported
+        self.readings = {}       # stream key -> (time taken, C) of its latest reading
+        self.errors = {}         # stream key -> decode_errors() counts, once there are any
+        self.memory = None       # decode_free() of the latest 'F' frame
+        self.replies = collections.Counter()  # command reply frames received, by type
+        self.frames = 0          # binary frames received; none from an old or blank sketch
+        self.box_id = None       # name the firmware answers ID with
+        self.released = False    # True while someone else (the uploader) owns the port
+
+    def connected(self):
+        return self.ser is not None
+
+    def name(self):
+        return self.box_id or os.path.basename(self.port)
+
+    def min_interval(self):
+        # shortest useful sampling interval (s): the sensors' conversion time
+        return max((sensor['conversion'] for sensor in self.sensors if sensor), default=MIN_INTERVAL)
+
+    def streams(self):
+        # keys of the box's sensors' readings, the control sensor's first:
+        # their ROM codes, which the firmware's channel numbers can change
+        # under (CONTROL), or channel numbers for a sketch that doesn't
+        # report ROMs or a box not asked for its sensors yet
+        return [self.stream_key(channel) for channel in range(max(len(self.sensors), 1))]
+
+    def stream_key(self, key):
+        # a channel number stands for whichever sensor is on that channel
+        if not isinstance(key, int):
+            return key
+        sensor = self.sensors[key] if key < len(self.sensors) else None
+        return sensor['rom'] if sensor and sensor['rom'] else key
+
+    def stream_name(self, key, first=None):
+        # what a stream's readings go by: the box's name for its first
+        # stream (the control sensor's, unless first says otherwise), else
+        # box/sensor, the sensor named in sensors.json or by ROM code
+        if first is None:
+            first = self.stream_key(key) == self.streams()[0]
+        if first:
+            return self.name()
+        key = self.stream_key(key)
+        return '{}/{}'.format(self.name(), load_sensor_names().get(key) or key)
+
+    def latest(self):
+        # latest reading in C, or None.  Never touches the port.
+        return self.temperature
+
+    def latest_sample(self, key=0):
+        # (time taken, C, relay on or None) of a stream's latest reading
+        # (see streams(); 0, the control sensor's, by default), or None
+        key = self.stream_key(key)
+        if self.temperature is None or key not in self.readings:
+            return None
+        return self.readings[key] + (self.relay,)
+
+    def switches_since(self, count):
+        # relay switches after the first `count` ever seen, as (time, on)
+        new = min(self.nswitches - count, len(self.switches))
+        return list(self.switches)[len(self.switches) - new:] if new > 0 else []
+
+    def start_meter(self):
+        # starts the lamp's RelayMeter over, from now
+        self.meter.start(dt.datetime.now(), self.relay)
+
+    def relay_stats(self):
+        return self.meter.stats(dt.datetime.now())
+
+    def notify(self):
+        pass
+
+    def feed(self, data):
+        for item in self.parser.feed(data):
+            if item[0] == 'frame':
+                self._handle_frame(item[1], item[2])
+            else:
+                self._handle_line(item[1])
+
+    def _open_port(self, timeout):
+        try:
+            self.ser = serial.Serial(self.port, self.baud, timeout=timeout)
+        except (serial.SerialException, OSError):
+            self.ser = None
+        self.parser = FrameParser()
+        self.seq = None
+        self.clock = DeviceClock()
+        return self.ser is not None
+
+    def _close_port(self):
+        ser, self.ser = self.ser, None
+        if ser is not None:
+            try:
+                ser.close()
+            except (serial.SerialException, OSError):
+                pass
+        self.temperature = None
+        self.readings = {}
+        self.errors = {}  # the Arduino resets when the port opens
+        self.notify()
+
+    def _handle_frame(self, ftype, payload):
+        self.frames += 1
+        if ftype == FRAME_SAMPLE and len(payload) in (4, 8, 11, 12):
+            seq, temperature, relay, millis, channel = decode_sample(payload)
+            if self.seq is not None:
+                self.dropped += (seq - self.seq - 1) % 256
+            self.seq = seq
+            self._set_reading(temperature, relay, millis, channel)
+        elif ftype == FRAME_SETPOINT and len(payload) == 4:
+            self.setpoint, self.margin = decode_setpoint(payload)
+            self._set_reply(ftype)
+        elif ftype == FRAME_RELAY and len(payload) == 5:
+            on, millis = decode_relay(payload)
+            self._set_relay(self.clock.stamp(millis, time.time()), on)
+            self.notify()
+        elif ftype == FRAME_PID and len(payload) == 15:
+            self.control = decode_pid(payload)
+            self._set_reply(ftype)
+        elif ftype == FRAME_SENSOR and len(payload) in (4, 13, 14):
+            channel, count, sensor = decode_sensor(payload)
+            sensors = (self.sensors + [None]*count)[:count]
+            if channel < count:
+                sensors[channel] = sensor
+            self.sensors = sensors
+            if channel >= count - 1:
+                self._set_reply(ftype)  # the last of them
+        elif ftype == FRAME_ERRORS and len(payload) == 7:
+            channel, counts = decode_errors(payload)
+            self.errors[self.stream_key(channel)] = counts
+            self.notify()
+        elif ftype == FRAME_FREE and len(payload) == 4:
+            self.memory = decode_free(payload)
+            self._set_reply(ftype)
+        elif ftype == FRAME_ID:
+            self.box_id = payload.decode('ascii', 'replace')
+            self._set_reply(ftype)
+        elif ftype == FRAME_NAK:
+            self._set_reply(ftype)
+
+    def _set_reply(self, ftype):
+        self.replies[ftype] += 1
+        self.notify()
+
+    def _reply_counts(self, text):
+        # {frame type: replies of it so far} for the frames that can answer
+        # a command line, for _answer()
+        return {ftype: self.replies[ftype] for ftype in (REPLY_FRAMES.get(text.split()[0]), FRAME_NAK)}
+
+    def _answer(self, counts):
+        # the type of the frame that answered since _reply_counts(), or None
+        for ftype, count in counts.items():
+            if self.replies[ftype] != count:
+                return ftype
+        return None
+
+    def _handle_line(self, line):
+        # old text-only firmware: one temperature per line (the first
+        # sensor's, if there are several; -- if it wasn't read)
+        try:
+            temperature = float(line.split('\t')[0])
+        except ValueError:
+            return  # partial line right after open, or noise
+        self._set_reading(temperature, None)
+
+    def _set_reading(self, temperature, relay, millis=None, channel=0):
+        if millis is None:
+            taken = dt.datetime.now()  # old sketch: when it got here will have to do
+        else:
+            taken = self.clock.stamp(millis, time.time())
+        self.readings[self.stream_key(channel)] = (taken, temperature)
+        if channel != 0:
+            self.notify()
+            return
+        self.temperature = temperature
+        self.stamp = time.monotonic()
+        self.taken = taken
+        if relay is not None and relay != self.relay:
+            self._set_relay(self.taken, relay)  # the switch's own frame was lost, or an old sketch
+        self.notify()
+
+    def _set_relay(self, stamp, on):
+        if on == self.relay:
+            return
+        if self.relay is not None:
+            self.switches.append((stamp, on))
+            self.nswitches += 1
+        self.relay = on
+        self.meter.switch(stamp, on)
+
+
+class BoxLink(BoxState):
+    local = True  # talks to the serial port itself (see proofdaemon.RemoteLink)
+
+    def __init__(self, port=PORT, baud=BAUD):
+        super().__init__(port, baud)
+        self.cmdlock = threading.Lock()  # one command in flight at a time
+        self.running = False
+        self.thread = None
+        self.cond = threading.Condition()  # held while the state changes
+
+    def start(self):
+        if self.running:
+            return
+        self.running = True
+        self._open()  # so connected() is meaningful as soon as we return
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join(timeout=2)
+        self._close()
+
+    @contextlib.contextmanager
+    def release(self):
+        # closes the port so another program (arduino --upload) can use it,
+        # and reopens it afterwards
+        self.released = True
+        self._close()
+        try:
+            yield
+        finally:
+            self.released = False
+
+    def reading(self, timeout=FIRST_READING_WAIT):
+        # latest reading in C, waiting for the first one after a (re)connect
+        with self.cond:
+            if self.temperature is None:
+                self.cond.wait_for(lambda: self.temperature is not None, timeout)
+            return self.temperature
+
+    def sample(self, timeout=FIRST_READING_WAIT, key=0):
+        # reading() with the time it was taken and the relay state: (datetime,
+        # C, relay on), or None; or the same for another of the box's
+        # sensors (see streams())
+        with self.cond:
+            if self.reading(timeout) is None:
+                return None
+            return self.latest_sample(key)
+
+    def switches_since(self, count):
+        with self.cond:
+            return super().switches_since(count)
+
+    def start_meter(self):
+        with self.cond:
+            super().start_meter()
+
+    def relay_stats(self):
+        with self.cond:
+            return super().relay_stats()
+
+    def next_reading(self, timeout=FIRST_READING_WAIT):
+        # waits for a reading newer than the one we have now
+        with self.cond:
+            stamp = self.stamp
+            self.cond.wait_for(lambda: self.stamp != stamp, timeout)
+            if self.stamp == stamp:
+                return None
+            return self.temperature
+
+    def command(self, text, timeout=REPLY_WAIT):
+        # sends one command line and waits for the frame that answers it
+        # (see REPLY_FRAMES); returns its type, or None if the firmware didn't answer (or isn't there).
+        # Right after the port opens the board is still in its bootloader,
+        # which would eat the command, so wait for the sketch's first reading.
+        if self.ser is None or self.reading(timeout) is None:
+            return None
+        with self.cmdlock:
+            with self.cond:
+                counts = self._reply_counts(text)
+            ser = self.ser
+            if ser is None:
+                return None
+            try:
+                ser.write((text + '\n').encode('ascii'))
+            except (serial.SerialException, OSError):
+                return None
+            with self.cond:
+                self.cond.wait_for(lambda: self._answer(counts) is not None, timeout)
+                return self._answer(counts)
+
+    def get_box_id(self, timeout=REPLY_WAIT):
+        # asks the firmware for its name; None if it doesn't have one (old
+        # sketch) or didn't answer
+        if self.command('ID', timeout) != FRAME_ID:
+            return None
+        return self.box_id
+
+    def identify(self, timeout=REPLY_WAIT):
+        # the box's name and sensors, as discover_boxes() wants them
+        if self.get_box_id(timeout) is not None:
+            self.get_sensors()
+
+    def get_sensors(self, timeout=REPLY_WAIT):
+        # the box's sensors by channel (see decode_sensor), or None
+        if self.command('RES', timeout) != FRAME_SENSOR:
+            return None
+        return self.sensors
+
+    def set_resolution(self, bits, timeout=REPLY_WAIT):
+        # sets the DS18B20s' and DS1822s' resolution (9-12 bits); returns the
+        # sensors as reported after, or None if it couldn't be set
+        if self.command('RES {:d}'.format(bits), timeout) != FRAME_SENSOR:
+            return None
+        return checked_resolution(self.sensors, bits)
+
+    def get_memory(self, timeout=REPLY_WAIT):
+        # the Arduino's free RAM (see decode_free), or None if the firmware
+        # can't tell us
+        if self.command('FREE', timeout) != FRAME_FREE:
+            return None
+        return self.memory
+
+    def set_control_sensor(self, rom, timeout=REPLY_WAIT):
+        # makes the sensor with this ROM code the one that runs the lamp;
+        # returns the sensors as reported after, or None if it couldn't be
+        with self.cond:
+            command = control_sensor_command(self.sensors, rom)
+        if command is None or self.command(command, timeout) != FRAME_SENSOR:
+            return None
+        return checked_control_sensor(self.sensors, rom)
+
+    def get_setpoint(self, timeout=REPLY_WAIT):
+        # set point in C as reported by the firmware, or None
+        if self.command('GET', timeout) != FRAME_SETPOINT:
+            return None
+        return self.setpoint
+
+    def set_setpoint(self, setpoint, timeout=REPLY_WAIT):
+        # changes the set point (C) on the fly; returns the new set point
+        # as confirmed by the firmware, or None if it couldn't be set
+        if self.command('SET {:4.2f}'.format(setpoint), timeout) != FRAME_SETPOINT:
+            return None
+        return checked_setpoint(self.setpoint, setpoint)
+
+    def get_control(self, timeout=REPLY_WAIT):
+        # control mode and PID settings (see decode_pid), or None if the
+        # firmware doesn't do PID or didn't answer
+        if self.command('PID', timeout) != FRAME_PID:
+            return None
+        return self.control
+
+    def set_mode(self, mode, timeout=REPLY_WAIT):
+        # mode: 'onoff' or 'pid'; returns the new settings, or None
+        if self.command('MODE ' + mode.upper(), timeout) != FRAME_PID:
+            return None
+        return checked_control(self.control, mode=mode)
+
+    def set_pid(self, kp, ki, kd, window, timeout=REPLY_WAIT):
+        # new PID gains and window (s), kept by the firmware over resets
+        if self.command(pid_command(kp, ki, kd, window), timeout) != FRAME_PID:
+            return None
+        return checked_control(self.control, kp=kp, ki=ki, kd=kd, window=int(round(window)))
+
+    def notify(self):
+        with self.cond:
+            self.cond.notify_all()
+
+    def feed(self, data):
+        with self.cond:
+            super().feed(data)
+
+    def _open(self):
+        return self._open_port(timeout=1)
+
+    def _close(self):
+        with self.cond:
+            self._close_port()
+
+    def _run(self):
+        while self.running:
+            if self.released:
+                time.sleep(RETRY_INTERVAL)
+                continue
+            if self.ser is None and not self._open():
+                time.sleep(RETRY_INTERVAL)
+                continue
+            ser = self.ser
+            try:
+                rawdata = ser.read(ser.in_waiting or 1)
+            except (serial.SerialException, OSError, AttributeError):
+                if self.released or ser is not self.ser:
+                    continue  # closed under us on purpose
+                print('Lost connection to Arduino on', self.port)
+                self._close()
+                continue
+            self.feed(rawdata)
+
+
+def checked_setpoint(reported, requested):
+    # the set point the firmware reported after SET, or None if it kept the
+    # old one because the new one was out of its range
+    if reported is None or abs(reported - requested) > 0.01:
+        return None
+    return reported
+
+
+def checked_control(reported, **requested):
+    # the control settings the firmware reported, or None if it didn't take
+    # the requested ones (out of range)
+    if reported is None:
+        return None
+    for key, value in requested.items():
+        if isinstance(value, str):
+            if reported[key] != value:
+                return None
+        elif abs(reported[key] - value) > 1e-3*max(abs(value), 1e-3):
+            return None
+    return reported
+
+
+def checked_resolution(sensors, bits):
+    # the sensors the firmware reported, or None if none of them is at the
+    # requested resolution
+    if not any(sensor and sensor['resolution'] == bits for sensor in sensors):
+        return None
+    return sensors
+
+
+def control_sensor_command(sensors, rom):
+    # the CONTROL command that hands the lamp to the sensor with this ROM
+    # code, or None if it isn't one of them or isn't answering
+    for channel, sensor in enumerate(sensors):
+        if sensor and sensor['rom'] == rom and sensor['found']:
+            return 'CONTROL {:d}'.format(channel)
+    return None
+
+
+def checked_control_sensor(sensors, rom):
+    # the sensors the firmware reported after CONTROL, or None if the
+    # requested one didn't become the control sensor
+    if not sensors or not sensors[0] or sensors[0]['rom'] != rom:
+        return None
+    return sensors
+
+
+def candidate_ports():
+    # serial ports that look like they could have an Arduino on them
+    from serial.tools import list_ports
+    ports = []
+    for port in list_ports.comports():
+        if port.vid in ARDUINO_VIDS or 'ttyACM' in port.device or 'ttyUSB' in port.device:
+            ports.append(port.device)
+    return sorted(ports)
+
+
+def discover_boxes(ports=None):
+    # started BoxLinks for every port (default: candidate_ports()) with a
+    # proofing box on it, each identified by its firmware ID.  The ports are
+    # probed in parallel, so this takes one board reset however many there
+    # are.  Their sensors are asked for too, for min_interval().  A board
+    # running the old text-only sketch has no ID but still counts; it goes
+    # by its port name.
+    if ports is None:
+        ports = candidate_ports()
+    links = [BoxLink(port) for port in ports]
+    if not links:
+        return []
+    for link in links:
+        link.start()
+    with concurrent.futures.ThreadPoolExecutor(len(links)) as pool:
+        list(pool.map(lambda link: link.identify(FIRST_READING_WAIT), links))
+    found = []
+    for link in links:
+        if link.box_id is None and link.latest() is None:
+            link.stop()  # nothing talking on this port
+        else:
+            found.append(link)
+    return found
+
+
+class Deadlines:
+    # Drift-free timing for a sampling loop: the k-th read is due at
+    # start + k*interval on the monotonic clock, however long the reads
+    # take.  Keeps score of how late each read actually started, and of
+    # deadlines skipped because a read overran a whole interval.
+    def __init__(self, interval):
+        self.next = time.monotonic() + interval
+        self.count = 0
+        self.late_total = 0.
+        self.late_max = 0.
+        self.missed = 0
+        self.first = None  # monotonic time of the first and latest reads
+        self.last = None
+
+    def wait_time(self):
+        # seconds until the next read is due
+        return max(self.next - time.monotonic(), 0.)
+
+    def fired(self, interval):
+        # call as each read starts; sets the deadline after it
+        now = time.monotonic()
+        while now - self.next >= interval:
+            self.next += interval
+            self.missed += 1
+        late = now - self.next
+        self.count += 1
+        self.late_total += late
+        self.late_max = max(self.late_max, late)
+        if self.first is None:
+            self.first = now
+        self.last = now
+        self.next += interval
+
+    def stats(self):
+        # actual mean interval, mean and worst lateness (s) and deadlines
+        # missed, or None before the second read
+        if self.count < 2:
+            return None
+        return {'interval': (self.last - self.first)/(self.count - 1),
+                'late_mean': self.late_total/self.count, 'late_max': self.late_max,
+                'missed': self.missed}
+
+
+class Acquisition:
+    # Takes a reading every `interval` seconds on a background thread and
+    # hands it to on_sample(time, temperature in C, relay on or None).
+    # read() returns (time taken, C, relay), or None if there's no reading;
+    # the same reading twice running is only passed on once.  Reads are due
+    # on absolute deadlines (see Deadlines); in between the thread sleeps on
+    # an Event, so it costs nothing and stops immediately.
+    # on_finished(message) is called once at the end; message is '' for a
+    # normal stop.
+    def __init__(self, read, interval, on_sample, on_finished=None):
+        self.read = read
+        self.interval = interval
+        self.on_sample = on_sample
+        self.on_finished = on_finished
+        self.stopping = threading.Event()
+        self.thread = None
+        self.deadlines = None
+
+    def start(self):
+        self.stopping.clear()
+        self.deadlines = Deadlines(self.interval)
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.stopping.set()
+
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def timing(self):
+        # Deadlines.stats() with the requested interval, or None
+        stats = self.deadlines.stats() if self.deadlines else None
+        if stats is not None:
+            stats['requested'] = self.interval
+        return stats
+
+    def _run(self):
+        message = ''
+        last = None
+        while not self.stopping.wait(self.deadlines.wait_time()):
+            self.deadlines.fired(self.interval)
+            sample = self.read()
+            if sample is None:
+                print('No reading from Arduino, skipping point')
+                continue
+            stamp, temperature, relay = sample
+            if stamp == last:
+                continue  # sampling faster than the firmware reads
+            last = stamp
+            if temperature == 999.99:
+                message = 'Arduino reported a sensor error'
+                break
+            self.on_sample(stamp, temperature, relay)
+        if self.on_finished is not None:
+            self.on_finished(message)
+
+
+def format_errors(errors):
+    # one line of a sensor's error counts for people
+    return '{} bad CRC, {} power-on 85\xB0C, {} missed'.format(errors['crc'], errors['power_on'],
+                                                              errors['missed'])
+
+
+def format_timing(timing):
+    # one line of Acquisition.timing() for people
+    return ('{:.3f} s requested, {:.3f} s actual; late by {:.1f} ms mean, {:.1f} ms worst; '
+            '{} missed').format(timing['requested'], timing['interval'], 1000*timing['late_mean'],
+                                1000*timing['late_max'], timing['missed'])
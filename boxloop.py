@@ -0,0 +1,249 @@
+# boxloop - proofing box links on an asyncio event loop
+# (c) 2022, 2024 - Jabez McClelland jabezmcc@gmail.com
+#
+# The same protocol as boxlink.BoxLink, but instead of a reader thread per
+# port, each port's file descriptor is watched by the event loop
+# (loop.add_reader), and reconnecting, sampling and commands are all
+# tasks on that loop.  One thread then serves any number of boxes, their
+# sampling timers and the daemon's API server together.  Linux/macOS only:
+# add_reader doesn't take serial ports on Windows.
+#
+# Everything here must be called from the loop's thread.
+#
+import asyncio
+import contextlib
+
+import serial
+
+from boxlink import (BAUD, FIRST_READING_WAIT, FRAME_FREE, FRAME_ID, FRAME_PID, FRAME_SENSOR,
+                     FRAME_SETPOINT, PORT, REPLY_WAIT, RETRY_INTERVAL, BoxState, Deadlines, candidate_ports,
+                     checked_control, checked_control_sensor, checked_resolution, checked_setpoint,
+                     control_sensor_command, pid_command)
+
+
+class AsyncBoxLink(BoxState):
+    local = True
+
+    def __init__(self, port=PORT, baud=BAUD):
+        super().__init__(port, baud)
+        self.changed = asyncio.Event()  # set, and replaced, whenever the state changes
+        self.cmdlock = asyncio.Lock()
+        self.task = None
+
+    def start(self):
+        # opens the port now, so connected() is meaningful at once, and
+        # keeps it open from then on
+        if self.task is not None:
+            return
+        self._open()
+        self.task = asyncio.get_running_loop().create_task(self._keep_open())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        self._close()
+
+    @contextlib.contextmanager
+    def release(self):
+        self.released = True
+        self._close()
+        try:
+            yield
+        finally:
+            self.released = False
+
+    async def reading(self, timeout=FIRST_READING_WAIT):
+        await self._wait_for(lambda: self.temperature is not None, timeout)
+        return self.temperature
+
+    async def sample(self, timeout=FIRST_READING_WAIT, key=0):
+        await self.reading(timeout)
+        return self.latest_sample(key)
+
+    async def next_reading(self, timeout=FIRST_READING_WAIT):
+        stamp = self.stamp
+        if not await self._wait_for(lambda: self.stamp != stamp, timeout):
+            return None
+        return self.temperature
+
+    async def command(self, text, timeout=REPLY_WAIT):
+        # as BoxLink.command
+        if self.ser is None or await self.reading(timeout) is None:
+            return None
+        async with self.cmdlock:
+            counts = self._reply_counts(text)
+            if self.ser is None:
+                return None
+            try:
+                self.ser.write((text + '\n').encode('ascii'))
+            except (serial.SerialException, OSError):
+                return None
+            await self._wait_for(lambda: self._answer(counts) is not None, timeout)
+            return self._answer(counts)
+
+    async def get_box_id(self, timeout=REPLY_WAIT):
+        if await self.command('ID', timeout) != FRAME_ID:
+            return None
+        return self.box_id
+
+    async def identify(self, timeout=REPLY_WAIT):
+        if await self.get_box_id(timeout) is not None:
+            await self.get_sensors()
+
+    async def get_sensors(self, timeout=REPLY_WAIT):
+        if await self.command('RES', timeout) != FRAME_SENSOR:
+            return None
+        return self.sensors
+
+    async def set_resolution(self, bits, timeout=REPLY_WAIT):
+        if await self.command('RES {:d}'.format(bits), timeout) != FRAME_SENSOR:
+            return None
+        return checked_resolution(self.sensors, bits)
+
+    async def get_memory(self, timeout=REPLY_WAIT):
+        if await self.command('FREE', timeout) != FRAME_FREE:
+            return None
+        return self.memory
+
+    async def set_control_sensor(self, rom, timeout=REPLY_WAIT):
+        command = control_sensor_command(self.sensors, rom)
+        if command is None or await self.command(command, timeout) != FRAME_SENSOR:
+            return None
+        return checked_control_sensor(self.sensors, rom)
+
+    async def get_setpoint(self, timeout=REPLY_WAIT):
+        if await self.command('GET', timeout) != FRAME_SETPOINT:
+            return None
+        return self.setpoint
+
+    async def set_setpoint(self, setpoint, timeout=REPLY_WAIT):
+        if await self.command('SET {:4.2f}'.format(setpoint), timeout) != FRAME_SETPOINT:
+            return None
+        return checked_setpoint(self.setpoint, setpoint)
+
+    async def get_control(self, timeout=REPLY_WAIT):
+        if await self.command('PID', timeout) != FRAME_PID:
+            return None
+        return self.control
+
+    async def set_mode(self, mode, timeout=REPLY_WAIT):
+        if await self.command('MODE ' + mode.upper(), timeout) != FRAME_PID:
+            return None
+        return checked_control(self.control, mode=mode)
+
+    async def set_pid(self, kp, ki, kd, window, timeout=REPLY_WAIT):
+        if await self.command(pid_command(kp, ki, kd, window), timeout) != FRAME_PID:
+            return None
+        return checked_control(self.control, kp=kp, ki=ki, kd=kd, window=int(round(window)))
+
+    def notify(self):
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    async def _wait_for(self, predicate, timeout):
+        # True once predicate() holds, False if it didn't within timeout
+        async def wait():
+            while not predicate():
+                await self.changed.wait()
+        try:
+            await asyncio.wait_for(wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    def _open(self):
+        # non-blocking reads; the loop tells us when there is something
+        if not self._open_port(timeout=0):
+            return False
+        asyncio.get_running_loop().add_reader(self.ser.fileno(), self._readable)
+        return True
+
+    def _close(self):
+        if self.ser is not None:
+            asyncio.get_running_loop().remove_reader(self.ser.fileno())
+        self._close_port()
+
+    def _readable(self):
+        try:
+            rawdata = self.ser.read(self.ser.in_waiting or 1)
+        except (serial.SerialException, OSError):
+            print('Lost connection to Arduino on', self.port)
+            self._close()
+            return
+        self.feed(rawdata)
+
+    async def _keep_open(self):
+        while True:
+            await asyncio.sleep(RETRY_INTERVAL)
+            if self.ser is None and not self.released:
+                self._open()
+
+
+async def discover_boxes(ports=None):
+    # as boxlink.discover_boxes, with started AsyncBoxLinks
+    if ports is None:
+        ports = candidate_ports()
+    links = [AsyncBoxLink(port) for port in ports]
+    for link in links:
+        link.start()
+    await asyncio.gather(*(link.identify(FIRST_READING_WAIT) for link in links))
+    found = []
+    for link in links:
+        if link.box_id is None and link.latest() is None:
+            link.stop()
+        else:
+            found.append(link)
+    return found
+
+
+class AsyncAcquisition:
+    # boxlink.Acquisition as a task: read is a coroutine function, and
+    # between readings the task just sleeps on the loop
+    def __init__(self, read, interval, on_sample, on_finished=None):
+        self.read = read
+        self.interval = interval
+        self.on_sample = on_sample
+        self.on_finished = on_finished
+        self.task = None
+        self.deadlines = None
+
+    def start(self):
+        self.deadlines = Deadlines(self.interval)
+        self.task = asyncio.get_running_loop().create_task(self._run())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+
+    def running(self):
+        return self.task is not None and not self.task.done()
+
+    def timing(self):
+        stats = self.deadlines.stats() if self.deadlines else None
+        if stats is not None:
+            stats['requested'] = self.interval
+        return stats
+
+    async def _run(self):
+        message = ''
+        last = None
+        try:
+            while True:
+                await asyncio.sleep(self.deadlines.wait_time())
+                self.deadlines.fired(self.interval)
+                sample = await self.read()
+                if sample is None:
+                    print('No reading from Arduino, skipping point')
+                    continue
+                stamp, temperature, relay = sample
+                if stamp == last:
+                    continue  # sampling faster than the firmware reads
+                last = stamp
+                if temperature == 999.99:
+                    message = 'Arduino reported a sensor error'
+                    break
+                self.on_sample(stamp, temperature, relay)
+        finally:
+            if self.on_finished is not None:
+                self.on_finished(message)
@@ -0,0 +1,218 @@
+# liveplot - live temperature plot for the Prooferator main window
+# (c) 2022, 2024 - Jabez McClelland jabezmcc@gmail.com
+#
+import datetime as dt
+import time
+
+from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
+from matplotlib.collections import PolyCollection
+import matplotlib.dates as mdates
+
+
+COLORS = ('blue', 'red', 'green', 'darkorange', 'purple', 'brown',
+          'magenta', 'olive', 'cyan', 'black', 'gray', 'navy')
+FRAME_RATE = 2.  # most plot updates per second, however fast samples come in
+LAMP_BAND = 0.03  # height of each trace's lamp-on band, as a fraction of the axes
+
+
+class Trace:
+    # one box's line on the plot, with a band along the bottom showing
+    # when its lamp was on (the index'th band up, for several boxes)
+    def __init__(self, ax, store, color, label, index):
+        self.store = store
+        self.line, = ax.plot([], [], color=color, label=label)
+        self.tail, = ax.plot([], [], color=color, animated=True)
+        self.band = PolyCollection([], facecolors=color, alpha=0.3, transform=ax.get_xaxis_transform())
+        ax.add_collection(self.band)
+        self.bottom = index*LAMP_BAND
+        self.synced = 0   # samples the full line was last drawn with
+        self.blitted = 0  # samples on screen, drawn or blitted
+        self.switches = 0  # relay switches the band was drawn with
+
+    def sync_band(self):
+        y0, y1 = self.bottom, self.bottom + LAMP_BAND
+        self.band.set_verts([[(x0, y0), (x0, y1), (x1, y1), (x1, y0)]
+                             for x0, x1 in (mdates.date2num(span) for span in self.store.on_spans())])
+        self.switches = len(self.store.switches)
+
+    def remove(self):
+        self.line.remove()
+        self.tail.remove()
+        self.band.remove()
+
+
+class LivePlot:
+    # Temperature traces drawn from SampleStores (one per box) and updated
+    # in place as samples come in.  Updates are coalesced into frames, at
+    # most FRAME_RATE a second, so sampling fast can't swamp the GUI.
+    # After every full draw the rendered axes are cached; a frame then only
+    # restores that cache, draws the segments added since the last frame,
+    # blits them and re-caches, so the cost per frame doesn't depend on how
+    # long we've been recording.  The full Line2Ds are only
+    # brought up to date when a full draw is needed anyway (the limits have
+    # to grow, or the canvas is resized), and then only with the store's
+    # decimated() samples for the visible x range, about two per pixel, so
+    # a two-day log at 1 Hz draws as fast as a ten-minute one.
+    def __init__(self, canvas, ax):
+        self.canvas = canvas
+        self.ax = ax
+        self.traces = []
+        self.fahrenheit = False
+        self.background = None
+        self.view = None  # (xlim, width in pixels) the lines were synced for
+        self.window = None  # x span to scroll along with, None to show the whole run
+        self.start = dt.datetime.now()  # of the run, where the whole-run view begins
+        self.span = dt.timedelta(hours=2)  # least the whole-run view shows
+        self.last_frame = 0.
+        self.timer = canvas.new_timer()
+        self.timer.single_shot = True
+        self.timer.add_callback(self.frame)
+        self.scheduled = False
+        # lamp telemetry and the like, redrawn with every frame
+        self.info = ax.text(0.99, 0.98, '', transform=ax.transAxes, ha='right', va='top',
+                            fontsize='small', animated=True)
+        self.ax.xaxis_date()
+        canvas.mpl_connect('draw_event', self.on_draw)
+
+    def reset(self, stores, ylim, fahrenheit=False, labels=None, span=dt.timedelta(hours=2)):
+        for trace in self.traces:
+            trace.remove()
+        labels = labels or [None]*len(stores)
+        self.traces = [Trace(self.ax, store, COLORS[i % len(COLORS)], label, i)
+                       for i, (store, label) in enumerate(zip(stores, labels))]
+        self.info.set_text('')
+        legend = self.ax.get_legend()
+        if legend is not None:
+            legend.remove()
+        if len(self.traces) > 1:
+            self.ax.legend(loc='upper left')
+        self.fahrenheit = fahrenheit
+        self.start = dt.datetime.now()
+        self.span = span
+        self.ax.set_xlim(self.start, self.start + (self.window or span))
+        self.ax.set_ylim(*ylim)
+        self.redraw()
+
+    def set_window(self, window):
+        # window: timedelta to keep the newest samples in view, scrolling
+        # along as they come in, or None to show the whole run
+        self.window = window
+        newest = self.newest()
+        if window is not None and newest is not None:
+            self.scroll_to(newest)
+        elif window is None:
+            x0, x1 = self.ax.get_xlim()
+            self.ax.set_xlim(mdates.date2num(self.start), max(x1, mdates.date2num(self.start + self.span)))
+        self.redraw()
+
+    def set_units(self, fahrenheit, ylim):
+        self.fahrenheit = fahrenheit
+        self.ax.set_ylim(*ylim)
+        self.redraw()
+
+    def display(self, temps):
+        if self.fahrenheit:
+            return temps*9./5. + 32.
+        return temps
+
+    def redraw(self):
+        self.sync_lines()
+        self.canvas.draw_idle()
+
+    def current_view(self):
+        return self.ax.get_xlim(), max(int(self.ax.bbox.width), 1)
+
+    def sync_lines(self):
+        self.view = (xlim, width) = self.current_view()
+        start, stop = (mdates.num2date(x).replace(tzinfo=None) for x in xlim)
+        for trace in self.traces:
+            times, temps = trace.store.decimated(start, stop, width)
+            trace.line.set_data(mdates.date2num(times), self.display(temps))
+            trace.synced = trace.blitted = trace.store.total
+            trace.sync_band()
+
+    def set_info(self, text):
+        # text for the top right corner, shown from the next frame
+        self.info.set_text(text)
+
+    def append(self):
+        # call after samples have been added to any of the stores; they are
+        # drawn at the next frame
+        if self.scheduled:
+            return
+        self.scheduled = True
+        wait = self.last_frame + 1./FRAME_RATE - time.monotonic()
+        self.timer.interval = max(int(1000*wait), 0)
+        self.timer.start()
+
+    def frame(self):
+        self.scheduled = False
+        self.last_frame = time.monotonic()
+        tails = []
+        for trace in self.traces:
+            new = trace.store.total - trace.blitted
+            if new:
+                times, temps = trace.store.last(new + 1)
+                tails.append((trace, mdates.date2num(times), self.display(temps)))
+        if not tails:
+            return
+        changed = any(trace.switches != len(trace.store.switches) for trace in self.traces)
+        for trace, x, y in tails:
+            changed |= self.follow(x[-1], y.min(), y.max())
+        if changed or self.background is None:
+            self.sync_lines()
+            self.canvas.draw()
+        else:
+            self.blit_tails(tails)
+
+    def newest(self):
+        # time (as a date number) of the newest sample on the plot, or None
+        stamps = [trace.store.last()[0] for trace in self.traces if len(trace.store)]
+        return max(mdates.date2num(stamp[-1]) for stamp in stamps) if stamps else None
+
+    def follow(self, x, ymin, ymax):
+        # moves or widens the axes to take in samples up to time x with
+        # temperatures ymin..ymax; True if anything changed
+        changed = False
+        x0, x1 = self.ax.get_xlim()
+        if x > x1:
+            if self.window is None:
+                self.ax.set_xlim(x0, x0 + 2*(x - x0))
+            else:
+                self.scroll_to(x)
+            changed = True
+        y0, y1 = self.ax.get_ylim()
+        if ymin < y0 or ymax > y1:
+            pad = 0.1*(y1 - y0)
+            self.ax.set_ylim(min(y0, ymin - pad), max(y1, ymax + pad))
+            changed = True
+        return changed
+
+    def scroll_to(self, x):
+        # puts time x 90% of the way along the window, so the next
+        # scroll is a tenth of a window away
+        span = self.window/dt.timedelta(days=1)
+        self.ax.set_xlim(x - 0.9*span, x + 0.1*span)
+
+    def blit_tails(self, tails):
+        self.canvas.restore_region(self.background)
+        for trace, x, y in tails:
+            trace.tail.set_data(x, y)
+            self.ax.draw_artist(trace.tail)
+            trace.blitted = trace.store.total
+        self.background = self.canvas.copy_from_bbox(self.ax.bbox)
+        self.ax.draw_artist(self.info)
+        self.canvas.blit(self.ax.bbox)
+
+    def on_draw(self, event):
+        # full draw (first show, resize, new limits).  If samples were only
+        # blitted since the lines were last synced, or the view has changed,
+        # the draw just done is out of date: sync and draw again rather
+        # than cache it.
+        if self.view != self.current_view() or any(trace.synced != trace.store.total
+                                                   for trace in self.traces):
+            self.sync_lines()
+            self.canvas.draw_idle()
+            return
+        self.background = self.canvas.copy_from_bbox(self.ax.bbox)
+        self.ax.draw_artist(self.info)  # onto the buffer about to be shown
@@ -0,0 +1,458 @@
+# proofdaemon - headless Prooferator logger and controller
+# (c) 2022, 2024 - Jabez McClelland jabezmcc@gmail.com
+#
+# Run with "python prooferator.py --daemon".  It keeps the Arduinos' ports
+# open, logs a reading from each box every interval to a CSV file per box
+# (the same Recorder the GUI uses), and answers a small control API on a
+# local TCP socket, so a 24/7 logger needs no X session, Qt or matplotlib.
+# The GUI can attach to it as a client with "python prooferator.py --attach".
+#
+# The ports, the sampling timers and the API clients are all served by one
+# asyncio event loop (see boxloop.py), so more boxes don't mean more threads.
+#
+# The API is one JSON object per line in each direction:
+#   {"cmd": "boxes"}                   names of the boxes being logged
+#   {"cmd": "status"}                  latest reading, relay, set point, errors, ...
+#   {"cmd": "samples", "since": time}  logged samples after an ISO time
+#   {"cmd": "switches", "since": n}    relay switches after the first n
+#   {"cmd": "setpoint"}                set point (and on/off margin) from the Arduino
+#   {"cmd": "setpoint", "value": C}    change the set point
+#   {"cmd": "control"}                 control mode and PID settings
+#   {"cmd": "control", "mode": m}      switch to "onoff" or "pid" control
+#   {"cmd": "control", "pid": [kp, ki, kd, window]}  new PID settings
+#   {"cmd": "sensors"}                 the box's sensors and resolution
+#   {"cmd": "sensors", "resolution": n}  set the DS18B20s' resolution (9-12 bits)
+#   {"cmd": "sensors", "control": rom}  run the lamp from the sensor with this ROM
+#   {"cmd": "memory"}                  the Arduino's free RAM, now and lowest
+# Requests about a box may name it with "box": name; without one they go
+# to the first box.  A box with several sensors is logged as several
+# boxes, box/sensor for each sensor after the first (see
+# BoxState.stream_name()); the lamp and control commands of any of them
+# go to the box.  Every reply has "ok"; failed requests also have "error".
+#
+import argparse
+import asyncio
+import collections
+import datetime as dt
+import functools
+import json
+import os
+import signal
+import socket
+import threading
+
+from boxlink import CONTROL_MODES, FASTEST_INTERVAL, MIN_INTERVAL, PORT, RESOLUTIONS, SETPOINT_RANGE
+from boxloop import AsyncAcquisition, AsyncBoxLink, discover_boxes
+from prooflog import Recorder
+
+HOST = '127.0.0.1'  # local only: there is no authentication
+API_PORT = 8642
+INTERVAL = 60.      # seconds between logged readings
+RECENT = 1440       # samples kept in memory for clients (a day at 1/min)
+TIMEOUT = 5.        # client side, per request
+
+
+class BoxLogger:
+    # one box, or one of its sensors (key, see BoxState.streams()): its
+    # link, name, log and sampler.  The box's first logger runs the link and
+    # has the lamp.  The name is fixed at startup, so it keeps matching the
+    # log file and sensors.json isn't read per request.
+    def __init__(self, link, key, first, name, interval, logfile):
+        self.link = link
+        self.key = key
+        self.first = first
+        self.stream = name
+        self.recorder = Recorder(logfile)
+        self.recent = collections.deque(maxlen=RECENT)
+        self.acq = AsyncAcquisition(functools.partial(link.sample, key=key), interval,
+                                    self.add_sample, self.finished)
+        self.message = ''
+
+    def name(self):
+        return self.stream
+
+    def start(self):
+        if self.first:
+            self.link.start()
+            self.link.start_meter()
+        self.acq.start()
+
+    def stop(self):
+        self.acq.stop()
+        self.recorder.close()
+        if self.first:
+            self.link.stop()
+
+    def add_sample(self, stamp, temperature, relay):
+        self.recorder.write(stamp, temperature, relay)
+        self.recent.append((stamp, temperature, relay))
+
+    def finished(self, message):
+        self.message = message
+        if message:
+            print(message)
+
+    async def handle(self, request):
+        cmd = request.get('cmd')
+        if cmd == 'status':
+            key = self.link.stream_key(self.key)
+            taken, temperature = self.link.readings.get(key, (None, None))
+            return {'ok': True, 'box': self.name(), 'connected': self.link.connected(),
+                    'temperature': temperature, 'relay': self.link.relay,
+                    'time': taken and taken.isoformat(),
+                    'setpoint': self.link.setpoint, 'margin': self.link.margin,
+                    'recording': self.acq.running(),
+                    'interval': self.acq.interval, 'timing': self.acq.timing(),
+                    'log': self.recorder.path,
+                    'samples': self.recorder.count, 'dropped': self.link.dropped,
+                    'switches': self.link.nswitches if self.first else 0,
+                    'lamp': lamp_json(self.link.relay_stats()) if self.first else None,
+                    'sensors': self.link.sensors, 'errors': self.link.errors.get(key),
+                    'message': self.message}
+        if cmd == 'samples':
+            since = request.get('since')
+            since = dt.datetime.fromisoformat(since) if since else dt.datetime.min
+            samples = [(stamp.isoformat(), temp, relay) for stamp, temp, relay in self.recent
+                       if stamp > since]
+            return {'ok': True, 'samples': samples}
+        if cmd == 'switches':
+            if not self.first:
+                return {'ok': True, 'switches': []}  # the box's lamp is with its first logger
+            switches = self.link.switches_since(int(request.get('since', 0)))
+            return {'ok': True, 'switches': [(stamp.isoformat(), on) for stamp, on in switches]}
+        if cmd == 'setpoint':
+            value = request.get('value')
+            if value is None:
+                setpoint = await self.link.get_setpoint()
+            elif not SETPOINT_RANGE[0] < float(value) < SETPOINT_RANGE[1]:
+                return {'ok': False, 'error': 'set point out of range'}
+            else:
+                setpoint = await self.link.set_setpoint(float(value))
+            if setpoint is None:
+                return {'ok': False, 'error': 'no answer from Arduino'}
+            return {'ok': True, 'setpoint': setpoint, 'margin': self.link.margin}
+        if cmd == 'control':
+            mode, pid = request.get('mode'), request.get('pid')
+            if mode is not None and mode not in CONTROL_MODES:
+                return {'ok': False, 'error': 'unknown control mode {!r}'.format(mode)}
+            if pid is not None:
+                control = await self.link.set_pid(*(float(value) for value in pid))
+                if control is not None and mode is not None:
+                    control = await self.link.set_mode(mode)
+            elif mode is not None:
+                control = await self.link.set_mode(mode)
+            else:
+                control = await self.link.get_control()
+            if control is None:
+                return {'ok': False, 'error': 'no answer from Arduino, or settings refused'}
+            return {'ok': True, 'control': control}
+        if cmd == 'sensors':
+            bits, rom = request.get('resolution'), request.get('control')
+            if rom is not None:
+                sensors = await self.link.set_control_sensor(rom)
+                if sensors is None:
+                    return {'ok': False, 'error': 'no answer from Arduino, or no such sensor answering'}
+                return {'ok': True, 'sensors': sensors}
+            if bits is None:
+                sensors = await self.link.get_sensors()
+            elif int(bits) not in RESOLUTIONS:
+                return {'ok': False, 'error': 'resolution must be 9 to 12 bits'}
+            else:
+                sensors = await self.link.set_resolution(int(bits))
+            if sensors is None:
+                return {'ok': False, 'error': 'no answer from Arduino, or resolution not settable'}
+            return {'ok': True, 'sensors': sensors}
+        if cmd == 'memory':
+            memory = await self.link.get_memory()
+            if memory is None:
+                return {'ok': False, 'error': 'no answer from Arduino, or it can\'t tell'}
+            return {'ok': True, 'memory': memory}
+        return {'ok': False, 'error': 'unknown command {!r}'.format(cmd)}
+
+
+def lamp_json(stats):
+    # RelayMeter.stats() with the period in seconds
+    if stats is None:
+        return None
+    stats = dict(stats)
+    if stats['period'] is not None:
+        stats['period'] = stats['period'].total_seconds()
+    return stats
+
+
+class Daemon:
+    def __init__(self, links, interval, logfile):
+        # one log per box and sensor, named after them when there is more
+        # than one
+        stem, ext = os.path.splitext(logfile)
+        streams = [(link, key, key == link.streams()[0]) for link in links for key in link.streams()]
+        streams = [(link, key, first, link.stream_name(key, first)) for link, key, first in streams]
+        self.loggers = [BoxLogger(link, key, first, name, interval, logfile if len(streams) == 1 else
+                                  '{}_{}{}'.format(stem, name.replace('/', '_'), ext))
+                        for link, key, first, name in streams]
+
+    def start(self):
+        for logger in self.loggers:
+            logger.start()
+
+    def stop(self):
+        for logger in self.loggers:
+            logger.stop()
+
+    async def handle(self, request):
+        if request.get('cmd') == 'boxes':
+            return {'ok': True, 'boxes': [logger.name() for logger in self.loggers]}
+        name = request.get('box')
+        for logger in self.loggers:
+            if name is None or logger.name() == name:
+                return await logger.handle(request)
+        return {'ok': False, 'error': 'no box named {!r}'.format(name)}
+
+    async def serve_client(self, reader, writer):
+        # one API connection: a JSON request per line, a JSON reply per line
+        try:
+            async for line in reader:
+                try:
+                    reply = await self.handle(json.loads(line))
+                except (ValueError, TypeError, AttributeError) as e:
+                    reply = {'ok': False, 'error': str(e)}
+                writer.write(json.dumps(reply).encode() + b'\n')
+                await writer.drain()
+        except (ConnectionError, asyncio.CancelledError):
+            pass  # client went away, or we're shutting down
+        finally:
+            writer.close()
+
+
+class RemoteLink:
+    # Stands in for BoxLink in the GUI when it is attached to a daemon: the
+    # daemon owns the serial port and we ask it over the API instead.
+    local = False
+
+    def __init__(self, address=(HOST, API_PORT), box=None):
+        self.address = address
+        self.box = box
+        self.sock = None
+        self.rfile = None
+        self.lock = threading.Lock()
+        self.relay = None
+        self.setpoint = None
+        self.margin = None  # on/off hysteresis band, C
+        self.dropped = 0
+        self.nswitches = 0
+        self.lamp = None
+        self.sensors = []
+        self.errors = {}
+        self.control = None  # as the latest control request reported it
+
+    def request(self, **request):
+        # one round trip; None if the daemon can't be reached
+        with self.lock:
+            try:
+                if self.sock is None:
+                    self.sock = socket.create_connection(self.address, TIMEOUT)
+                    self.rfile = self.sock.makefile('rb')
+                if self.box is not None:
+                    request['box'] = self.box
+                self.sock.sendall(json.dumps(request).encode() + b'\n')
+                line = self.rfile.readline()
+                if not line:
+                    raise OSError('daemon closed the connection')
+                return json.loads(line)
+            except (OSError, ValueError):
+                self._close()
+                return None
+
+    def _close(self):
+        if self.sock is not None:
+            self.sock.close()
+        self.sock = None
+        self.rfile = None
+
+    def start(self):
+        self.status()
+
+    def stop(self):
+        with self.lock:
+            self._close()
+
+    def status(self):
+        reply = self.request(cmd='status')
+        if reply is None:
+            return None
+        self.relay = reply['relay']
+        self.dropped = reply['dropped']
+        self.nswitches = reply['switches']
+        self.lamp = reply['lamp']
+        self.sensors = reply['sensors']
+        self.errors = {0: reply['errors']} if reply.get('errors') else {}
+        if reply['setpoint'] is not None:
+            self.setpoint = reply['setpoint']
+            self.margin = reply['margin']
+        return reply
+
+    def min_interval(self):
+        return max((sensor['conversion'] for sensor in self.sensors if sensor), default=MIN_INTERVAL)
+
+    def streams(self):
+        return [0]  # the daemon serves each of a box's sensors as a box of its own
+
+    def stream_key(self, key):
+        return key
+
+    def stream_name(self, key, first=None):
+        return self.name()
+
+    def name(self):
+        return self.box or '{}:{}'.format(*self.address)
+
+    def connected(self):
+        reply = self.status()
+        return reply is not None and reply['connected']
+
+    def latest(self):
+        reply = self.status()
+        return None if reply is None else reply['temperature']
+
+    def reading(self, timeout=None):
+        return self.latest()
+
+    def sample(self, timeout=None, key=0):
+        reply = self.status()
+        if reply is None or reply['temperature'] is None:
+            return None
+        return dt.datetime.fromisoformat(reply['time']), reply['temperature'], reply['relay']
+
+    def switches_since(self, count):
+        reply = self.request(cmd='switches', since=count)
+        if reply is None:
+            return []
+        return [(dt.datetime.fromisoformat(stamp), on) for stamp, on in reply['switches']]
+
+    def start_meter(self):
+        pass  # the daemon's meter runs from when it started logging
+
+    def relay_stats(self):
+        stats = self.lamp
+        if stats is not None and stats['period'] is not None:
+            stats = dict(stats, period=dt.timedelta(seconds=stats['period']))
+        return stats
+
+    def get_setpoint(self, timeout=None):
+        reply = self.request(cmd='setpoint')
+        if reply is None or not reply['ok']:
+            return None
+        self.setpoint, self.margin = reply['setpoint'], reply['margin']
+        return self.setpoint
+
+    def set_setpoint(self, setpoint, timeout=None):
+        reply = self.request(cmd='setpoint', value=setpoint)
+        if reply is None or not reply['ok']:
+            return None
+        self.setpoint, self.margin = reply['setpoint'], reply['margin']
+        return self.setpoint
+
+    def _control_request(self, **request):
+        reply = self.request(cmd='control', **request)
+        if reply is None or not reply['ok']:
+            return None
+        self.control = reply['control']
+        return self.control
+
+    def sensors_request(self, **request):
+        reply = self.request(cmd='sensors', **request)
+        if reply is None or not reply['ok']:
+            return None
+        self.sensors = reply['sensors']
+        return self.sensors
+
+    def get_sensors(self, timeout=None):
+        return self.sensors_request()
+
+    def set_resolution(self, bits, timeout=None):
+        return self.sensors_request(resolution=bits)
+
+    def set_control_sensor(self, rom, timeout=None):
+        return self.sensors_request(control=rom)
+
+    def get_control(self, timeout=None):
+        return self._control_request()
+
+    def get_memory(self, timeout=None):
+        reply = self.request(cmd='memory')
+        if reply is None or not reply['ok']:
+            return None
+        return reply['memory']
+
+    def set_mode(self, mode, timeout=None):
+        return self._control_request(mode=mode)
+
+    def set_pid(self, kp, ki, kd, window, timeout=None):
+        return self._control_request(pid=[kp, ki, kd, window])
+
+
+def remote_links(address):
+    # a RemoteLink for each box the daemon at address is logging
+    reply = RemoteLink(address).request(cmd='boxes')
+    if reply is None:
+        return [RemoteLink(address)]
+    return [RemoteLink(address, name) for name in reply['boxes']]
+
+
+def parse_address(text):
+    # 'host:port', 'port' or 'host' -> (host, port)
+    host, _, port = text.rpartition(':')
+    if not host and not port.isdigit():
+        return (port, API_PORT)
+    return (host or HOST, int(port))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(prog='prooferator.py --daemon',
+                                     description='Headless Prooferator logger and controller')
+    parser.add_argument('--daemon', action='store_true', help=argparse.SUPPRESS)
+    parser.add_argument('--serial', action='append',
+                        help='Arduino serial port; repeat for more boxes (default: look for them)')
+    parser.add_argument('--listen', default='{}:{}'.format(HOST, API_PORT),
+                        help='address for the control API (default %(default)s)')
+    parser.add_argument('--interval', type=float, default=INTERVAL,
+                        help='seconds between logged readings (default %(default)s)')
+    parser.add_argument('--log', default='proofingbox.csv',
+                        help='CSV log file, with the box name added when there are several '
+                        '(default %(default)s)')
+    args = parser.parse_args(argv)
+    if args.interval < FASTEST_INTERVAL:
+        parser.error('the shortest interval is {:g} s'.format(FASTEST_INTERVAL))
+
+    try:
+        asyncio.run(serve(args))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+async def serve(args):
+    if args.serial:
+        # ask the named ports for their IDs too, but keep the quiet ones:
+        # the box may just not be plugged in yet
+        found = {link.port: link for link in await discover_boxes(args.serial)}
+        links = [found.get(port) or AsyncBoxLink(port) for port in args.serial]
+    else:
+        links = await discover_boxes() or [AsyncBoxLink(PORT)]
+    daemon = Daemon(links, args.interval, args.log)
+    host, port = parse_address(args.listen)
+    server = await asyncio.start_server(daemon.serve_client, host, port, reuse_address=True)
+    stopping = asyncio.Event()
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, stopping.set)
+    daemon.start()
+    for logger in daemon.loggers:
+        print('Logging {} every {:g} s to {}'.format(logger.name(), args.interval, logger.recorder.path))
+        if args.interval < logger.link.min_interval():
+            print('  (it reads every {:g} s at its resolution; repeats are skipped)'.format(
+                logger.link.min_interval()))
+    print('API on {}:{}'.format(*server.sockets[0].getsockname()[:2]))
+    try:
+        await stopping.wait()
+    finally:
+        server.close()
+        daemon.stop()
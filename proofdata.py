@@ -0,0 +1,219 @@
+# proofdata - storage for the proofing box temperature log
+# (c) 2022, 2024 - Jabez McClelland jabezmcc@gmail.com
+#
+# Samples live in NumPy arrays (datetime64[ms] times, float32 temperatures
+# in C, int8 relay states) rather than Python lists of datetime objects and
+# floats, which keeps a multi-day log at 1 Hz to ~13 bytes per sample.
+# The relay's switches are kept too, as they happen, for the lamp's
+# on-periods.  Plotting and statistics read from the store through views,
+# so nothing is copied to look at the data.
+#
+# For plotting long logs, decimated() gives about two samples per screen
+# pixel from a min/max pyramid (MinMaxPyramid), whatever the length of the
+# log, without losing spikes.
+#
+import datetime as dt
+
+import numpy as np
+
+TIME_DTYPE = 'datetime64[ms]'
+TEMP_DTYPE = np.float32
+RELAY_UNKNOWN = -1
+FANOUT = 4  # samples per block at the pyramid's first level, blocks per block above
+
+
+class SampleStore:
+    # capacity=None grows without limit (doubling, so appends are amortized
+    # O(1)).  capacity=N keeps only the newest N samples as a ring.  The
+    # ring is stored twice over (every sample is written at i and i+N), so
+    # the newest N samples are always one contiguous slice and views never
+    # have to be stitched together.
+    def __init__(self, capacity=None, initial=1024):
+        self.capacity = capacity
+        size = 2*capacity if capacity else initial
+        self.t = np.empty(size, dtype=TIME_DTYPE)
+        self.temp = np.empty(size, dtype=TEMP_DTYPE)
+        self.relay = np.empty(size, dtype=np.int8)  # 1 on, 0 off, RELAY_UNKNOWN
+        self.switches = []  # (datetime64, relay on), in order
+        self.n = 0      # samples held
+        self.head = 0   # start of the held samples in the buffers
+        self.total = 0  # samples ever appended
+        self.pyramid = None  # built on the first decimated()
+
+    def __len__(self):
+        return self.n
+
+    def clear(self):
+        self.n = 0
+        self.head = 0
+        self.total = 0
+        self.switches = []
+
+    def append(self, stamp, temp, relay=None):
+        stamp = np.datetime64(stamp, 'ms')
+        relay = RELAY_UNKNOWN if relay is None else int(relay)
+        if self.capacity:
+            i = (self.head + self.n) % self.capacity
+            self.t[i] = self.t[i + self.capacity] = stamp
+            self.temp[i] = self.temp[i + self.capacity] = temp
+            self.relay[i] = self.relay[i + self.capacity] = relay
+            if self.n < self.capacity:
+                self.n += 1
+            else:
+                self.head = (self.head + 1) % self.capacity
+        else:
+            if self.n == len(self.t):
+                self.t = np.concatenate((self.t, np.empty_like(self.t)))
+                self.temp = np.concatenate((self.temp, np.empty_like(self.temp)))
+                self.relay = np.concatenate((self.relay, np.empty_like(self.relay)))
+            self.t[self.n] = stamp
+            self.temp[self.n] = temp
+            self.relay[self.n] = relay
+            self.n += 1
+        self.total += 1
+
+    def switch(self, stamp, on):
+        # the relay switched on or off at stamp
+        self.switches.append((np.datetime64(stamp, 'ms'), bool(on)))
+
+    def times(self):
+        return self.t[self.head:self.head + self.n]
+
+    def temps(self):
+        return self.temp[self.head:self.head + self.n]
+
+    def relays(self):
+        return self.relay[self.head:self.head + self.n]
+
+    def on_spans(self):
+        # [(on, off)] datetime64 pairs for the lamp's on-periods among the
+        # samples held; a period still going ends at the newest sample
+        if self.n == 0:
+            return []
+        first, newest = self.times()[0], self.times()[-1]
+        spans = []
+        start = first if self.relays()[0] == 1 else None
+        for stamp, on in self.switches:
+            if on and start is None:
+                start = max(stamp, first)
+            elif not on and start is not None:
+                if stamp > first:
+                    spans.append((start, stamp))
+                start = None
+        if start is not None and start < newest:
+            spans.append((start, newest))
+        return spans
+
+    def last(self, count=1):
+        # views of the newest `count` samples
+        start = self.head + max(self.n - count, 0)
+        return self.t[start:self.head + self.n], self.temp[start:self.head + self.n]
+
+    def span(self, start=None, stop=None):
+        # (i0, i1): times()[i0:i1] are the samples with start <= time < stop
+        # (datetimes or datetime64); times are in order so this is two
+        # binary searches
+        times = self.times()
+        i0 = 0 if start is None else int(np.searchsorted(times, np.datetime64(start, 'ms')))
+        i1 = self.n if stop is None else int(np.searchsorted(times, np.datetime64(stop, 'ms')))
+        return i0, i1
+
+    def window(self, start=None, stop=None):
+        # views of the samples with start <= time < stop
+        i0, i1 = self.span(start, stop)
+        return self.times()[i0:i1], self.temps()[i0:i1]
+
+    def decimated(self, start=None, stop=None, points=1000):
+        # at most about 2*points samples (copies) tracing the same outline
+        # as all of those between start and stop, plus one either side so
+        # a line drawn through them reaches the edges
+        if self.pyramid is None:
+            self.pyramid = MinMaxPyramid(self)
+        i0, i1 = self.span(start, stop)
+        i0, i1 = max(i0 - 1, 0), min(i1 + 1, self.n)
+        if i0 >= i1:
+            return self.times()[:0], self.temps()[:0]
+        index = self.pyramid.indices(i0, i1, points)
+        index = np.unique(np.concatenate(([i0, i1 - 1], index)))
+        return self.times()[index], self.temps()[index]
+
+    def stats(self, start=None, stop=None):
+        # min, mean and max temperature in C over a time window, or None
+        times, temps = self.window(start, stop)
+        if len(temps) == 0:
+            return None
+        return {'min': float(temps.min()), 'mean': float(temps.mean(dtype=np.float64)),
+                'max': float(temps.max()), 'count': len(temps),
+                'span': (times[-1] - times[0]).astype('timedelta64[ms]').astype(dt.timedelta)}
+
+
+class MinMaxPyramid:
+    # Level k holds, for each complete block of FANOUT**k samples, the
+    # indices of its lowest and highest sample.  Drawing those two samples
+    # per block, from the coarsest level that still has `points` blocks in
+    # view, keeps every spike (a relay-on overshoot is some block's max) at
+    # a cost that depends on `points`, not on the length of the log.
+    # Levels are extended as samples come in, a few new blocks at a time.
+    # Indices are into store.times()/temps(); a ring store shifts them
+    # once it is full, so then the pyramid is rebuilt (its size is bounded
+    # anyway).
+    def __init__(self, store):
+        self.store = store
+        self.levels = []  # [imin, imax, count] per level, k = 1, 2, ...
+        self.first = 0    # store.total - store.n when the levels were built
+        self.total = 0    # store.total when the levels were last extended
+
+    def update(self):
+        store = self.store
+        first = store.total - store.n
+        if store.total < self.total or first != self.first:
+            self.levels = []  # cleared, or the ring has moved on
+        self.first = first
+        self.total = store.total
+        temps = store.temps()
+        size = FANOUT
+        k = 0
+        while store.n // size:
+            if k == len(self.levels):
+                self.levels.append([np.empty(16, dtype=np.int64), np.empty(16, dtype=np.int64), 0])
+            level = self.levels[k]
+            done, count = level[2], store.n // size
+            if count > done:
+                if k == 0:
+                    imin = imax = np.arange(done*FANOUT, count*FANOUT).reshape(-1, FANOUT)
+                else:
+                    below = self.levels[k - 1]
+                    imin = below[0][done*FANOUT:count*FANOUT].reshape(-1, FANOUT)
+                    imax = below[1][done*FANOUT:count*FANOUT].reshape(-1, FANOUT)
+                rows = np.arange(count - done)
+                self._extend(level, imin[rows, temps[imin].argmin(axis=1)],
+                             imax[rows, temps[imax].argmax(axis=1)])
+            size *= FANOUT
+            k += 1
+
+    def _extend(self, level, imin, imax):
+        count = level[2] + len(imin)
+        if count > len(level[0]):
+            grown = max(count, 2*len(level[0]))
+            level[0] = np.resize(level[0], grown)
+            level[1] = np.resize(level[1], grown)
+        level[0][level[2]:count] = imin
+        level[1][level[2]:count] = imax
+        level[2] = count
+
+    def indices(self, i0, i1, points):
+        # sorted indices of the samples to draw for samples [i0, i1).  With
+        # fewer than FANOUT points a level could have no complete block in
+        # view, and the leftover would be the same range again.
+        self.update()
+        points = max(points, FANOUT)
+        k, size = 0, 1
+        while k < len(self.levels) and i1 - i0 > points*size:
+            k, size = k + 1, size*FANOUT
+        if k == 0:
+            return np.arange(i0, i1)
+        imin, imax, count = self.levels[k - 1]
+        b0, b1 = i0//size, min(i1//size, count)
+        pairs = np.sort(np.stack((imin[b0:b1], imax[b0:b1]), axis=1), axis=1).ravel()
+        # the samples after the last complete block come from finer levels
+        return np.concatenate((pairs, self.indices(max(b1*size, i0), i1, points)))
@@ -18,39 +18,103 @@
 #
 import sys
 import os
-import xlsxwriter
+import argparse
+import functools
 import datetime as dt
-import time
-import numpy as np
-import serial
+import math
 import pathlib
 import re
 import platform
+import random
 import subprocess
 import threading
+import time
+
+import importlib.util
+
+if __name__=="__main__" and '--daemon' in sys.argv[1:]:
+    # Headless logger/controller: don't even import Qt
+    import proofdaemon
+    sys.exit(proofdaemon.main(sys.argv[1:]))
 
+from PyQt5 import QtWidgets
 from PyQt5.QtCore import QObject,  pyqtSignal
-from PyQt5.QtWidgets import QApplication, QDesktopWidget, QFileDialog, QMessageBox
-from PyQt5.uic import loadUiType
+from PyQt5.QtWidgets import QActionGroup, QApplication, QDesktopWidget, QFileDialog, QInputDialog, QMessageBox
 
-from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg as FigureCanvas
-import matplotlib.pyplot as plt
+# matplotlib, numpy and xlsxwriter are imported where they're first needed
+# (the main window, the sample store, saving), not here: the welcome window
+# needs none of them and they are most of our startup time.  Keep it that
+# way; bench_startup.py checks.
+from boxlink import (MIN_INTERVAL, RESOLUTIONS, SETPOINT_RANGE, Acquisition, BoxLink, discover_boxes,
+                     format_errors, format_timing, load_sensor_names, save_sensor_names)
+
+srcdir = pathlib.Path(__file__).parent.resolve()
+uicache = srcdir / 'uicache'
+
+def load_ui(uifile):
+    # Returns (form class, base class) for a Qt Designer file, like
+    # loadUiType, but without parsing the XML on every launch: the .ui is
+    # compiled once into uicache/ui_<name>.py and only recompiled when the
+    # .ui file is newer.  If that can't be done, fall back to loadUiType.
+    uipath = srcdir / uifile
+    pypath = uicache / ('ui_' + uipath.stem + '.py')
+    try:
+        if not pypath.exists() or pypath.stat().st_mtime < uipath.stat().st_mtime:
+            compile_ui(uipath, pypath)
+        spec = importlib.util.spec_from_file_location(pypath.stem, pypath)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return getattr(module, module.ui_form), getattr(QtWidgets, module.ui_base)
+    except Exception as e:
+        print('Using', uifile, 'directly:', e)
+        from PyQt5.uic import loadUiType
+        return loadUiType(str(uipath))
 
-Ui_MainWindow, QMainWindow = loadUiType('prooferator.ui') 
-Ui_WelcomeWindow, QWelcomeWindow = loadUiType('welcomewindow.ui')
-Ui_AboutWindow, QAboutWindow = loadUiType('aboutProoferator.ui')
-Ui_UpdatingArduino, QUpdatingArduino = loadUiType('updating_arduino.ui')
+def compile_ui(uipath, pypath):
+    from PyQt5.uic import compileUi
+    import xml.etree.ElementTree as ET
+    widget = ET.parse(uipath).getroot().find('widget')
+    uicache.mkdir(exist_ok=True)
+    tmppath = pypath.with_suffix('.tmp')
+    with open(tmppath, 'w') as fout:
+        compileUi(str(uipath), fout)
+        fout.write('\nui_form = {!r}\nui_base = {!r}\n'.format('Ui_' + widget.get('name'), widget.get('class')))
+    os.replace(tmppath, pypath)
+
+Ui_MainWindow, QMainWindow = load_ui('prooferator.ui') 
+Ui_WelcomeWindow, QWelcomeWindow = load_ui('welcomewindow.ui')
+Ui_AboutWindow, QAboutWindow = load_ui('aboutProoferator.ui')
+Ui_UpdatingArduino, QUpdatingArduino = load_ui('updating_arduino.ui')
 vers = '0.2.1'
 
+link = BoxLink()  # the box the windows are showing, one of links
+links = [link]    # every proofing box we're talking to
+
 class Welcome(QWelcomeWindow, Ui_WelcomeWindow):
     def __init__(self):
         super(Welcome,self).__init__()
         self.setupUi(self)
-        self.currentTemp = get_temp()
-        self.setPoint = float(get_arduino_setpoint())
-        self.gotNumber = self.currentTemp.replace('.','').isdigit()
+        # Show straight away; the Arduino is probed in the background and
+        # the labels are filled in when it answers.
+        self.currentTemp = '--.-'
+        self.setPoint = None
+        self.gotNumber = False
+        self.probing = True
+        self.nboxes = 0
         self.updateText()
         self.wradioButtonF.toggled.connect(lambda:self.unitchanged(self.wradioButtonF))        
+        self.helper = ProbeHelper()
+        self.helper.finished.connect(self.probed)
+        self.probe = threading.Thread(target=probe_arduino, args=(self.helper,), daemon=True)
+        self.probe.start()
+
+    def probed(self,temp,setpoint,nboxes):
+        self.currentTemp = temp
+        self.setPoint = setpoint
+        self.nboxes = nboxes
+        self.gotNumber = self.currentTemp.replace('.','').replace('-','',1).isdigit()
+        self.probing = False
+        self.updateText()
         
     def updateText(self):
         # Do temperature label
@@ -60,16 +124,24 @@ class Welcome(QWelcomeWindow, Ui_WelcomeWindow):
                 tempstring = '{:3.1f}'.format(temp*9./5. + 32)+'\xB0F'
             else:
                 tempstring = '{:3.1f}'.format(temp)+'\xB0C'
-            self.foundArduinoLabel.setText('Found Arduino...')            
+            if self.nboxes > 1:
+                self.foundArduinoLabel.setText('Found {} proofing boxes...'.format(self.nboxes))
+            else:
+                self.foundArduinoLabel.setText('Found Arduino...')            
         else:
             if self.wradioButtonF.isChecked():
                 tempstring = self.currentTemp+'\xB0F'
             else:
                 tempstring = self.currentTemp+'\xB0C'             
-            self.foundArduinoLabel.setText('Arduino not found!')
+            if self.probing:
+                self.foundArduinoLabel.setText('Looking for Arduino...')
+            else:
+                self.foundArduinoLabel.setText('Arduino not found!')
         self.currentTempLabel.setText('Current temp: '+tempstring) 
         # Do setpoint label
-        if self.wradioButtonF.isChecked():
+        if self.setPoint is None:
+            spstring = '--.-'+('\xB0F' if self.wradioButtonF.isChecked() else '\xB0C')
+        elif self.wradioButtonF.isChecked():
             spstring = '{:3.1f}'.format(self.setPoint*9./5. + 32)+'\xB0F' 
         else:
             spstring = '{:3.1f}'.format(self.setPoint)+'\xB0C'
@@ -113,11 +185,41 @@ class UpdatingArduino(QUpdatingArduino, Ui_UpdatingArduino):
 class Helper(QObject):
     finished = pyqtSignal()
 
+class ProbeHelper(QObject):
+    finished = pyqtSignal(str, object, int)
+
+class AcquisitionHelper(QObject):
+    # the int is the index of the box in Main.runs
+    sample = pyqtSignal(int, object, float, object)
+    finished = pyqtSignal(int, str)
+
+class Run:
+    # one box's share of a recording, or one of its sensors' (key, see
+    # BoxState.streams()): its link, name, samples, log and sampler.  The
+    # lamp goes with the box's first run, its control sensor's when the
+    # recording starts.  The name is fixed then too, so the log and the
+    # spreadsheet match and sensors.json isn't read per sample.
+    def __init__(self, box, key, name, store, recorder):
+        self.box = box
+        self.key = key
+        self.first = key == box.streams()[0]
+        self.stream = name
+        self.store = store
+        self.recorder = recorder
+        self.acq = None
+        self.switches = box.nswitches  # relay switches already passed to the store
+        if self.first:
+            box.start_meter()
+
+    def name(self):
+        return self.stream
+
 class Main(QMainWindow, Ui_MainWindow):
     plotexists = False
     takedata = True
     datasaved = False
-    def __init__(self):
+    runs = []
+    def __init__(self,setpointC=None):
         super(Main,self).__init__()
         self.setupUi(self)
         self.actionExitButton.triggered.connect(self.exit)
@@ -128,13 +230,15 @@ class Main(QMainWindow, Ui_MainWindow):
         self.FradioButton.setText('\xB0F')
         self.FradioButton.toggled.connect(lambda:self.btnchanged(self.FradioButton))
         self.CradioButton.setText('\xB0C')
-        cwd = str(pathlib.Path(__file__).parent.resolve())
-        self.data_dest = cwd +'/proofingbox.xlsx'
+        self.data_dest = str(srcdir) +'/proofingbox.xlsx'
         self.dataSaveLabel.setText('Data will be saved in '+self.data_dest)
         self.changeDataButton.clicked.connect(self.change_data_dest)
         self.refreshTemp.clicked.connect(self.single_reading)
         self.timeintervalBox.setText('0.1')
-        self.setpointC = float(get_arduino_setpoint())
+        self.timeintervalBox.editingFinished.connect(self.change_interval)
+        if setpointC is None:
+            setpointC = float(get_arduino_setpoint())
+        self.setpointC = setpointC
         self.setpoint = self.setpointC   
         if self.FradioButton.isChecked():
             self.currentTempLabel.setText('--.-\xB0F')
@@ -144,7 +248,9 @@ class Main(QMainWindow, Ui_MainWindow):
         else:
             self.currentTempLabel.setText('--.-\xB0C')
             self.setpointBox.setText('{:4.2f}'.format(self.setpointC))
-        self.canvas = FigureCanvas(plt.Figure(figsize=(15, 6)))
+        from matplotlib.figure import Figure
+        from liveplot import FigureCanvas, LivePlot
+        self.canvas = FigureCanvas(Figure(figsize=(15, 6)))
         self.mainplot_layout.addWidget(self.canvas)
         self.ax = self.canvas.figure.subplots()
         self.ax.set_xlabel("Time")
@@ -155,32 +261,204 @@ class Main(QMainWindow, Ui_MainWindow):
         self.ax.set_title("Proofing Box Temperature Log")
         self.ax.set_position([.15,.15,.75,.75])
         self.ax.tick_params(axis='both',direction='in')
-        self.ax.set_ylim(self.setpoint*0.75,self.setpoint*1.25)
-        self.ax.set_xlim(dt.datetime.now(),dt.datetime.now()+dt.timedelta(hours=2))
+        self.liveplot = LivePlot(self.canvas, self.ax)
+        self.liveplot.reset([],(self.setpoint*0.75,self.setpoint*1.25),self.FradioButton.isChecked())
         self.rec_label.setText('')
+        self.build_box_menu()
+        self.build_view_menu()
+        self.build_control_menu()
+
+    def build_box_menu(self):
+        # Box menu: which box the temperature readout and set point refer to.
+        # Every box is recorded and plotted regardless.
+        self.menuBox = self.menuBar.addMenu('Box')
+        group = QActionGroup(self)
+        for i, box in enumerate(links):
+            action = self.menuBox.addAction(box.name())
+            action.setCheckable(True)
+            action.setChecked(box is link)
+            group.addAction(action)
+            action.triggered.connect(lambda checked, i=i: self.select_box(i))
+        self.menuBox.menuAction().setVisible(len(links) > 1)
+
+    def build_view_menu(self):
+        # View menu: the whole run, or the last few hours scrolling along
+        self.menuView = self.menuBar.addMenu('View')
+        group = QActionGroup(self)
+        for text, hours in (('Whole run',None),('Last hour',1),('Last 2 hours',2),('Last 8 hours',8)):
+            action = self.menuView.addAction(text)
+            action.setCheckable(True)
+            action.setChecked(hours is None)
+            group.addAction(action)
+            window = dt.timedelta(hours=hours) if hours else None
+            action.triggered.connect(lambda checked, window=window: self.liveplot.set_window(window))
+
+    def build_control_menu(self):
+        # Control menu: on/off or PID control of the selected box, which of
+        # its sensors runs the lamp, their resolution and names, and a
+        # relay-feedback test to tune the PID gains
+        self.menuControl = self.menuBar.addMenu('Control')
+        group = QActionGroup(self)
+        self.modeActions = {}
+        for text, mode in (('On/off (thermostat)','onoff'),('PID','pid')):
+            action = self.menuControl.addAction(text)
+            action.setCheckable(True)
+            group.addAction(action)
+            action.triggered.connect(lambda checked, mode=mode: self.send_control({'mode':mode}))
+            self.modeActions[mode] = action
+        # filled in by show_control(), from the box's sensors
+        self.menuControlSensor = self.menuControl.addMenu('Control sensor')
+        # DS18B20s' resolution: precision against readings per second
+        self.menuResolution = self.menuControl.addMenu('Sensor resolution')
+        group = QActionGroup(self)
+        self.resolutionActions = {}
+        for bits in RESOLUTIONS:
+            action = self.menuResolution.addAction('{} bit ({:g}\xB0C, {:g} s)'.format(
+                bits,0.5/2**(bits-9),(750 >> (12-bits))/1000.))
+            action.setCheckable(True)
+            group.addAction(action)
+            action.triggered.connect(lambda checked, bits=bits: self.send_control({'resolution':bits}))
+            self.resolutionActions[bits] = action
+        self.nameSensorsAction = self.menuControl.addAction('Name sensors...')
+        self.nameSensorsAction.triggered.connect(self.name_sensors)
+        self.menuControl.addSeparator()
+        self.autotuneAction = self.menuControl.addAction('Autotune PID...')
+        self.autotuneAction.triggered.connect(self.start_autotune)
+        self.stopTuneAction = self.menuControl.addAction('Stop autotune')
+        self.stopTuneAction.setEnabled(False)
+        self.stopTuneAction.triggered.connect(self.stop_autotune)
+        self.menuControl.aboutToShow.connect(self.show_control)
+        self.tuning = None
+
+    def show_control(self):
+        # tick the selected box's mode, as it last told us
+        control = link.control
+        for mode, action in self.modeActions.items():
+            action.setChecked(control is not None and control['mode']==mode)
+        resolutions = [sensor['resolution'] for sensor in link.sensors if sensor and sensor['resolution']]
+        self.menuResolution.setEnabled(bool(resolutions))
+        for bits, action in self.resolutionActions.items():
+            action.setChecked(bits in resolutions[:1])
+        self.nameSensorsAction.setEnabled(len(link.sensors) > 1)
+        self.menuControlSensor.clear()
+        names = load_sensor_names()
+        group = QActionGroup(self.menuControlSensor)
+        for channel, sensor in enumerate(link.sensors):
+            if not sensor or not sensor['rom']:
+                continue
+            action = self.menuControlSensor.addAction(names.get(sensor['rom']) or sensor['rom'])
+            action.setCheckable(True)
+            action.setChecked(channel==0)
+            action.setEnabled(sensor['found'])
+            group.addAction(action)
+            action.triggered.connect(lambda checked, rom=sensor['rom']: self.send_control({'sensor':rom}))
+        self.menuControlSensor.setEnabled(len(link.sensors) > 1)
+
+    def name_sensors(self):
+        # names for the selected box's extra sensors (the first goes by the
+        # box's name), for the plot legend and file names from the next recording
+        names = load_sensor_names()
+        for channel, sensor in enumerate(link.sensors[1:],1):
+            if not sensor:
+                continue
+            name, ok = QInputDialog.getText(self,'Prooferator','Name for sensor {} of {} ({}):'.format(
+                channel+1,link.name(),sensor['rom']),text=names.get(sensor['rom'],''))
+            if not ok:
+                return
+            if name.strip():
+                names[sensor['rom']] = name.strip().replace('/','-')
+            else:
+                names.pop(sensor['rom'],None)
+        try:
+            save_sensor_names(names)
+        except OSError as e:
+            QMessageBox.warning(self,'Prooferator','Unable to save sensor names\n'+str(e))
+
+    def send_control(self,container):
+        self.control = container
+        self.controlhelper = Helper()
+        self.controlhelper.finished.connect(self.control_sent)
+        threading.Thread(target=send_control, args=(self.controlhelper,container)).start()
+
+    def control_sent(self):
+        if self.control['result'] is None:
+            what = ('control mode' if 'mode' in self.control else
+                    'control sensor' if 'sensor' in self.control else 'sensor resolution')
+            QMessageBox.warning(self,'Prooferator','Unable to change the '+what+'.\n'
+                                'The Arduino may need reprogramming with the current sketch.')
+
+    def start_autotune(self):
+        if self.tuning is not None:
+            return
+        qbox = QMessageBox.question(self,'Prooferator',
+            'Autotune switches {} to on/off control and times {} heating cycles around the set point, '
+            'then sets PID gains from them and switches to PID control.  This can take an hour or more.\n\n'
+            'Start autotune?'.format(link.name(),AUTOTUNE_CYCLES),QMessageBox.Yes,QMessageBox.No)
+        if qbox!=QMessageBox.Yes:
+            return
+        self.tuning = {'box':link,'cancel':False}
+        self.tunehelper = Helper()
+        self.tunehelper.finished.connect(self.autotune_finished)
+        self.autotuneAction.setEnabled(False)
+        self.stopTuneAction.setEnabled(True)
+        threading.Thread(target=autotune, args=(self.tunehelper,self.tuning), daemon=True).start()
+
+    def stop_autotune(self):
+        if self.tuning is not None:
+            self.tuning['cancel'] = True
+
+    def autotune_finished(self):
+        tuning = self.tuning
+        self.tuning = None
+        self.autotuneAction.setEnabled(True)
+        self.stopTuneAction.setEnabled(False)
+        if tuning['error']:
+            QMessageBox.warning(self,'Prooferator','Autotune of {} stopped: {}'.format(
+                tuning['box'].name(),tuning['error']))
+        else:
+            QMessageBox.information(self,'Prooferator',
+                'Autotune of {} done: {:.2f} \xB0C swing, {:.1f} min cycle.\n'
+                'PID gains Kp {kp:.3g}, Ki {ki:.3g}, Kd {kd:.3g}; now under PID control.'.format(
+                tuning['box'].name(),2*tuning['amplitude'],tuning['period']/60.,**tuning['gains']))
+
+    def select_box(self,i):
+        global link
+        link = links[i]
+        self.setWindowTitle('Prooferator - '+link.name())
+        if link.setpoint is not None:
+            self.setpointC = link.setpoint
+            self.setpointF = self.setpointC*9./5. + 32.
+        self.btnchanged(None)
+        temp = link.latest()
+        unittext = '\xB0F' if self.FradioButton.isChecked() else '\xB0C'
+        if temp is None:
+            self.currentTempLabel.setText('--.-'+unittext)
+        else:
+            if self.FradioButton.isChecked():
+                temp = temp*9./5. + 32.
+            self.currentTempLabel.setText("{:3.1f}".format(temp)+unittext)
 
     def btnchanged(self,b):
         if self.CradioButton.isChecked():
             self.setpointBox.setText('{:3.1f}'.format(self.setpointC))
+            self.ax.set_ylabel("Temperature, \xB0C")
+            self.liveplot.set_units(False,(self.setpointC*0.75,self.setpointC*1.25))
         else:
             self.setpointBox.setText('{:3.1f}'.format(self.setpointF))
+            self.ax.set_ylabel("Temperature, \xB0F")
+            self.liveplot.set_units(True,(self.setpointF*0.75,self.setpointF*1.25))
                 
     def openabout(self):
         self.aboutwin = About()
 
     def single_reading(self):
         #print('in single reading')
-        try:
-            ser = serial.Serial('/dev/ttyACM0',9600, timeout=1)
-            dummy = False
-        except:
+        if link.connected():
+            current_tempC = link.reading()
+        else:
             QMessageBox.warning(self,'Prooferator','No Arduino detected, simulating data')
-            dummy = True        
-        if dummy:
             current_tempC = float(get_temp_dummy(self.setpointC))
-        else:
-            current_tempC = float(get_temp())
-        if current_tempC==999.99:
+        if current_tempC is None or current_tempC==999.99:
             return
         current_temp = current_tempC
         unittext = '\xB0C'
@@ -190,91 +468,190 @@ class Main(QMainWindow, Ui_MainWindow):
         self.currentTempLabel.setText("{:3.1f}".format(current_temp)+unittext)
         #print('Temp is',current_temp)
 
+    def recording(self):
+        return any(run.acq is not None and run.acq.running() for run in self.runs)
+
+    def read_interval(self):
+        # the time interval box in seconds, or None (with a warning) if it's no good
+        try:
+            interval = 60.*float(self.timeintervalBox.text())
+        except:
+            QMessageBox.warning(self,'Prooferator error','Invalid entry for time interval')
+            return None
+        shortest = min((box.min_interval() for box in links),default=MIN_INTERVAL)
+        if interval < shortest:
+            QMessageBox.warning(self,'Prooferator error','The shortest time interval is {:g} min ({:g} s)'.format(
+                shortest/60.,shortest))
+            return None
+        return interval
+
     def start_data(self):
+        if self.recording():
+            return
+        interval = self.read_interval()
+        if interval is None:
+            return
         self.takedata = True
         self.rec_label.setText('RECORDING')  
-        try:
-            ser = serial.Serial('/dev/ttyACM0',9600, timeout=1)
-            dummy = False
-        except:
+        boxes = [box for box in links if box.connected()]
+        dummy = not boxes
+        if dummy:
             QMessageBox.warning(self,'Prooferator','No Arduino detected, simulating data')
-            dummy = True
-        self.wb = xlsxwriter.Workbook(self.data_dest)
-        wbtimefmt = self.wb.add_format({'num_format': 'mmm d yyyy hh:mm:ss'})
-        ws = self.wb.add_worksheet()
-        ws.set_column(0,0,20)
-        ws.set_column(1,1,15)
-        ws.write(0,0,'Time')
-        ws.write(0,1,'Temperature')
-        times = []
-        temps = []
-        count = 0
-        self.ax.cla()
-        self.ax.set_xlabel("Time")
+            boxes = [link]
+        # Each box (and each extra sensor in a box) streams to its own CSV
+        # next to the spreadsheet as it goes; the spreadsheets are written
+        # from them when the data is saved.
+        from prooflog import Recorder
+        from proofdata import SampleStore
+        streams = [(box,key,box.stream_name(key)) for box in boxes for key in box.streams()]
+        self.runs = [Run(box,key,name,SampleStore(),Recorder(self.box_dest(name,'.csv')))
+                     for box,key,name in streams]
+        self.datasaved = False
+        setpoint = self.setpointC
         if self.FradioButton.isChecked():
             self.ax.set_ylabel("Temperature, \xB0F")
+            setpoint = self.setpointC*9./5. + 32.
         else:
             self.ax.set_ylabel("Temperature, \xB0C")  
-        self.ax.set_title("Proofing Box Temperature Log")
-        deltat = 0.1
-        while self.takedata:
-            try:
-                interval = 60.*float(self.timeintervalBox.text())
-            except:
-                QMessageBox.warning(self,'Prooferator error','Invalid entry for time interval')
-                break 
-            count += 1
-            elapsed_time = 0.0
-            while elapsed_time < interval:
-                time.sleep(deltat)
-                QApplication.processEvents()
-                if not self.takedata:
-                    break
-                elapsed_time += deltat
-            if not self.takedata:
-                break
+        self.liveplot.reset([run.store for run in self.runs],(setpoint*0.75,setpoint*1.25),
+                            self.FradioButton.isChecked(),[run.name() for run in self.runs])
+        self.plotexists = False
+        # Readings are taken on worker threads, one per box, and handed back
+        # to the GUI thread through the helper's signals, so the GUI is idle
+        # in between and one box never waits on another.
+        self.acqhelper = AcquisitionHelper()
+        self.acqhelper.sample.connect(self.add_sample)
+        self.acqhelper.finished.connect(self.acquisition_finished)
+        for i, run in enumerate(self.runs):
             if dummy:
-                current_tempC = float(get_temp_dummy(self.setpointC))
+                read = lambda: (dt.datetime.now(),float(get_temp_dummy(self.setpointC)),None)
             else:
-                current_tempC = float(get_temp())
-            if current_tempC==999.99:
-                break
-            current_temp = current_tempC
-            if self.FradioButton.isChecked():
-                current_temp = current_tempC*9./5. + 32. 
-            times.append(dt.datetime.now())            
-            temps.append(current_temp)
+                read = functools.partial(run.box.sample,key=run.key)
+            run.acq = Acquisition(read, interval, functools.partial(self.acqhelper.sample.emit,i),
+                                  functools.partial(self.acqhelper.finished.emit,i))
+            run.acq.start()
+
+    def change_interval(self):
+        if not self.runs:
+            return
+        interval = self.read_interval()
+        if interval is None:
+            return
+        for run in self.runs:
+            run.acq.interval = interval
+
+    def add_sample(self,i,stamp,current_tempC,relay):
+        if not self.takedata:
+            return
+        run = self.runs[i]
+        if run.first:
+            for switch in run.box.switches_since(run.switches):
+                run.store.switch(*switch)
+                run.switches += 1
+        run.store.append(stamp,current_tempC,relay)
+        run.recorder.write(stamp,current_tempC,relay)
+        current_temp = current_tempC
+        if self.FradioButton.isChecked():
+            current_temp = current_tempC*9./5. + 32. 
+        if run.box is link and run.box.stream_key(run.key) == run.box.stream_key(0):
             unittext = '\xB0C'
             if self.FradioButton.isChecked():
                  unittext = '\xB0F'
             self.currentTempLabel.setText("{:3.1f}".format(current_temp)+unittext)
-            ws.write(count,0,times[-1],wbtimefmt)
-            ws.write(count,1,temps[-1])
-            print('plotting point',count)
-            print('Current temp = ',current_temp)            
-            self.plot_data(data=[times,temps])
+        print('plotting point',run.recorder.count,'from',run.name())
+        print('Current temp = ',current_temp)            
+        self.liveplot.set_info('\n'.join(filter(None,(self.lamp_text(run) for run in self.runs))))
+        self.plot_data()
 
+    def lamp_text(self,run):
+        # live lamp telemetry for one box, e.g. 'Lamp 43% on, 6.2 min cycle, 0.12 Wh'
+        if not run.first:
+            return ''
+        stats = run.box.relay_stats()
+        if stats is None or (run.box.relay is None and not stats['cycles']):
+            return ''
+        text = 'Lamp {:.0f}% on'.format(100*stats['duty'])
+        if stats['period'] is not None:
+            text += ', {:.1f} min cycle'.format(stats['period'].total_seconds()/60.)
+        text += ', {:.2f} Wh'.format(stats['energy_wh'])
+        if len(self.runs) > 1:
+            text = run.box.name()+': '+text
+        return text
 
-    def plot_data(self,data=[[0],[0]]):
-        if self.plotexists:
-            self.lin.remove()
-        self.lin, = self.ax.plot(data[0],data[1],color='blue')
-        self.canvas.draw()
-        self.canvas.flush_events()
+    def acquisition_finished(self,i,message):
+        if not self.recording():
+            self.rec_label.setText('')
+        if message:
+            QMessageBox.warning(self,'Prooferator',self.runs[i].name()+': '+message)
+
+    def stop_acquisition(self):
+        self.takedata = False
+        self.rec_label.setText('')
+        for run in self.runs:
+            run.acq.stop()
+            run.recorder.flush()
+
+    def plot_data(self):
+        self.liveplot.append()
         self.plotexists = True       
     
     def stop_data(self):
-        self.takedata = False
-        self.rec_label.setText('')
+        self.stop_acquisition()
         qbox = QMessageBox.question(self,'Prooferator','Do you want to save data?',QMessageBox.Yes,QMessageBox.No)
         if self.plotexists:
             if qbox == QMessageBox.Yes:
-                self.wb.close()
-                self.datasaved = True
-                QMessageBox.information(self,'Prooferator','Acquisition finished.\nData saved in'+self.data_dest)
+                self.save_data()
+                dests = ', '.join(self.box_dest(run.name(),'.xlsx') for run in self.runs)
+                QMessageBox.information(self,'Prooferator','Acquisition finished.\nData saved in '+dests+self.stats_text())
         else:
             QMessageBox.information(self,'Prooferator','Please record some data first.')    
 
+    def box_dest(self,name,ext):
+        # where a box's (or sensor's) data goes: the data destination, with
+        # the name added when there is more than one box or sensor
+        base = os.path.splitext(self.data_dest)[0]
+        if len(links) > 1 or any(len(box.streams()) > 1 for box in links):
+            base = base+'_'+name.replace('/','_')
+        return base+ext
+
+    def save_data(self):
+        from prooflog import export_xlsx
+        for run in self.runs:
+            run.recorder.close()
+            dest = self.box_dest(run.name(),'.xlsx')
+            try:
+                export_xlsx(run.recorder.path,dest,self.FradioButton.isChecked())
+            except Exception as e:
+                QMessageBox.warning(self,'Prooferator','Unable to write '+dest+'\n'+str(e)+
+                                    '\nThe raw data is still in '+run.recorder.path)
+                return
+        self.datasaved = True
+
+    def stats_text(self):
+        text = ''
+        for run in self.runs:
+            stats = run.store.stats()
+            if stats is None:
+                continue
+            unittext = '\xB0C'
+            values = [stats['min'],stats['mean'],stats['max']]
+            if self.FradioButton.isChecked():
+                unittext = '\xB0F'
+                values = [v*9./5. + 32. for v in values]
+            name = run.name()+': ' if len(self.runs) > 1 else ''
+            text += '\n\n{}{} samples over {}\nMin/mean/max: {:3.1f}/{:3.1f}/{:3.1f}{}'.format(
+                name,stats['count'],str(stats['span']).split('.')[0],*values,unittext)
+            timing = run.acq.timing()
+            if timing is not None:
+                text += '\nInterval: '+format_timing(timing)
+            errors = run.box.errors.get(run.box.stream_key(run.key))
+            if errors:
+                text += '\nSensor: '+format_errors(errors)
+            lamp = self.lamp_text(run)
+            if lamp:
+                text += '\n'+lamp.split(': ')[-1]
+        return text
+
     def update_setpoint(self):
         try:
             self.setpoint = float(self.setpointBox.text())
@@ -284,6 +661,33 @@ class Main(QMainWindow, Ui_MainWindow):
         self.setpointC = self.setpoint
         if self.FradioButton.isChecked():
             self.setpointC = (self.setpoint - 32.)*5./9.
+        if not SETPOINT_RANGE[0] < self.setpointC < SETPOINT_RANGE[1]:
+            QMessageBox.warning(self,'Prooferator error','Setpoint out of range')
+            return
+        self.container = {'sp':self.setpointC}
+        if link.connected() or not link.local:
+            # Firmware that knows the SET command changes it on the fly
+            self.helper = Helper()
+            self.helper.finished.connect(self.setpoint_sent)
+            threading.Thread(target=send_setpoint, args=(self.helper,self.container)).start()
+        else:
+            self.reflash_arduino()
+
+    def setpoint_sent(self):
+        if self.container['error'] and not link.local:
+            # Attached to a daemon, which owns the port: we can't reprogram
+            QMessageBox.warning(self,'Prooferator','Unable to update set point through the Prooferator daemon.')
+        elif self.container['error'] and link.frames:
+            # It runs the current sketch and just didn't answer this time;
+            # reflashing would stop the proof for nothing
+            QMessageBox.warning(self,'Prooferator','The Arduino did not answer; set point not changed.\nPlease try again.')
+        elif self.container['error']:
+            # No answer: unprogrammed board or an old sketch, so program it
+            self.reflash_arduino()
+        else:
+            QMessageBox.information(self,'Prooferator','Arduino set point updated.')
+
+    def reflash_arduino(self):
         self.window = UpdatingArduino()
         
         qtRectangle = self.window.frameGeometry()
@@ -293,7 +697,6 @@ class Main(QMainWindow, Ui_MainWindow):
         self.window.show()
         self.helper = Helper()
         self.helper.finished.connect(self.window.close)
-        self.container = {'sp':self.setpointC}
         threading.Thread(target=update_arduino, args=(self.helper,self.container)).start()
         self.helper.finished.connect(self.reportoutcome)
     
@@ -316,17 +719,11 @@ class Main(QMainWindow, Ui_MainWindow):
         if not self.datasaved:
             qbox = QMessageBox.question(self,'Prooferator','Do you want to save data?',QMessageBox.Yes,QMessageBox.No)
             if qbox==QMessageBox.Yes:
-                self.takedata=False
-                self.rec_label.setText('')
-                try: 
-                    self.wb.close()
-                    self.datasaved = True
-                except:
-                    pass
+                self.stop_acquisition()
+                self.save_data()
                 sys.exit()
             else:
-                self.takedata=False
-                self.rec_label.setText('')
+                self.stop_acquisition()
                 sys.exit()
         else:
             sys.exit()
@@ -335,23 +732,21 @@ class Main(QMainWindow, Ui_MainWindow):
         if not self.datasaved:
             qbox = QMessageBox.question(self,'Prooferator','Do you want to save data?',QMessageBox.Yes,QMessageBox.No)
             if qbox==QMessageBox.Yes:
-                self.takedata=False
-                self.rec_label.setText('')
-                try:
-                    self.wb.close()
-                    self.datasaved = True
-                except:
-                    pass
+                self.stop_acquisition()
+                self.save_data()
                 event.accept()
             else:
-                self.takedata=False
-                self.rec_label.setText('')
+                self.stop_acquisition()
                 event.accept()
         else:
             event.accept()
 
 def get_arduino_setpoint():
-    # returns last programmed arduino setpoint in C as text
+    # returns arduino setpoint in C as text: from the Arduino itself if it
+    # answers, else the one last programmed into the sketch
+    setpoint = link.get_setpoint()
+    if setpoint is not None:
+        return '{:4.2f}'.format(setpoint)
     filename = './arduino_folder/proofingbox/proofingbox.ino'
     fin = open(filename,'r')
     lines = fin.readlines()
@@ -363,23 +758,103 @@ def get_arduino_setpoint():
             
 def get_temp():
     # returns current temp in C as text
-    try:
-        ser = serial.Serial('/dev/ttyACM0',9600, timeout=1)
-    except:
+    if not link.connected():
         return '--.-'
-    time.sleep(2)
-    try:
-        rawdata = ser.readline()
-        temperature = rawdata.decode('UTF-8').strip('\n')
-    except:
-        print('Error reading temperature')
-        temperature = 20.0 # Kludge in case of error 
-    return temperature
+    temperature = link.reading()
+    if temperature is None:
+        return '--.-'
+    return '{:4.2f}'.format(temperature)
+
+def probe_arduino(helper):
+    # looks for proofing boxes, then gets the current temp (text) and
+    # setpoint (C) of the first one, for the welcome window
+    global link
+    if link.local:
+        found = discover_boxes()
+        if found:
+            links[:] = found
+            link = found[0]
+        else:
+            link.start()  # nothing yet: keep trying the default port
+    helper.finished.emit(get_temp(),float(get_arduino_setpoint()),len(links))
 
 def get_temp_dummy(setpoint):
-    temperature = setpoint + 5.*(np.random.rand()-0.5)
+    temperature = setpoint + 5.*(random.random()-0.5)
     return "{:4.2f}".format(temperature)
 
+def send_setpoint(helper,container):
+    setpoint = link.set_setpoint(container['sp'])
+    container['error'] = setpoint is None
+    helper.finished.emit()
+
+def send_control(helper,container):
+    # container: {'mode': 'onoff' or 'pid'}, {'sensor': ROM code} or
+    # {'resolution': bits}; gets 'result', None on failure
+    if 'mode' in container:
+        container['result'] = link.set_mode(container['mode'])
+    elif 'sensor' in container:
+        container['result'] = link.set_control_sensor(container['sensor'])
+    else:
+        container['result'] = link.set_resolution(container['resolution'])
+    helper.finished.emit()
+
+AUTOTUNE_CYCLES = 3        # heating cycles timed, after one to settle
+AUTOTUNE_TIMEOUT = 4*3600. # give up after this long (s)
+
+def autotune(helper,container):
+    # Relay-feedback (Astrom-Hagglund) autotune: under on/off control the
+    # box cycles around the set point, with the lamp (output 0..1) switching
+    # between full and off.  The cycle's period is the ultimate period Tu,
+    # and from its amplitude a, with the hysteresis e (half the firmware's
+    # margin), the ultimate gain is Ku = 4d/(pi*sqrt(a^2 - e^2)) with
+    # d = 0.5.  The gains are Tyreus-Luyben's PI ones, which barely
+    # overshoot on a box this slow; no derivative, which would mostly
+    # amplify the sensor's 1/16 C steps.  Results go into container.
+    box = container['box']
+    container['error'] = ''
+    prior = box.get_control()
+    if prior is None or box.set_mode('onoff') is None:
+        container['error'] = 'the Arduino has no PID control, or did not answer'
+        helper.finished.emit()
+        return
+    started = dt.datetime.now()
+    count = box.nswitches
+    ons = []      # times the lamp came on
+    samples = []  # (time, C)
+    deadline = time.monotonic() + AUTOTUNE_TIMEOUT
+    while len(ons) < AUTOTUNE_CYCLES + 2:
+        if container['cancel'] or time.monotonic() > deadline:
+            container['error'] = 'cancelled' if container['cancel'] else 'the box did not cycle'
+            box.set_mode(prior['mode'])
+            helper.finished.emit()
+            return
+        for stamp, on in box.switches_since(count):
+            count += 1
+            if on and stamp >= started:
+                ons.append(stamp)
+        sample = box.sample()
+        if sample is not None and ons and (not samples or sample[0] != samples[-1][0]):
+            samples.append(sample[:2])
+        time.sleep(MIN_INTERVAL)
+    # the first cycle, from the first on, is still settling into the swing
+    temps = [temp for stamp, temp in samples if ons[1] <= stamp <= ons[-1]]
+    amplitude = (max(temps) - min(temps))/2.
+    period = (ons[-1] - ons[1]).total_seconds()/AUTOTUNE_CYCLES
+    box.get_setpoint()
+    hysteresis = (box.margin or 0.)/2.
+    if amplitude <= hysteresis or period <= 0:
+        container['error'] = 'the swing was too small to measure'
+        box.set_mode(prior['mode'])
+        helper.finished.emit()
+        return
+    ku = 4*0.5/(math.pi*math.sqrt(amplitude**2 - hysteresis**2))
+    kp = ku/3.2
+    gains = {'kp':kp, 'ki':kp/(2.2*period), 'kd':0.}
+    if box.set_pid(gains['kp'],gains['ki'],gains['kd'],prior['window']) is None or box.set_mode('pid') is None:
+        container['error'] = 'the Arduino did not take the new gains'
+    container.update(amplitude=amplitude, period=period, gains=gains)
+    helper.finished.emit()
+
 def update_arduino(helper,container):
     setpointtext = "{:4.2f}".format(container['sp'])
     print('UpdatingArduino with setpoint = ',setpointtext)
@@ -395,7 +870,10 @@ def update_arduino(helper,container):
     fout = open(filename,'w')
     fout.writelines(newlines)
     fout.close()
-    u = os.system('arduino --upload '+filename)
+    # only the selected box's port is released, so upload to that one and
+    # not whichever the IDE last used, likely another box still open here
+    with link.release():
+        u = os.system('arduino --upload --port '+link.port+' '+filename)
     if u:
         container['error']=True
         os.system('cp '+filename+'.bak '+filename)
@@ -404,10 +882,20 @@ def update_arduino(helper,container):
     helper.finished.emit()
 
 if __name__=="__main__":
-    app = QApplication(sys.argv)
+    parser = argparse.ArgumentParser(description='Arduino-controlled proofing box for bread dough')
+    parser.add_argument('--daemon', action='store_true', help='run headless; see --daemon --help')
+    parser.add_argument('--attach', nargs='?', const='', metavar='HOST:PORT',
+                        help='use a running daemon instead of the serial port')
+    args, qtargs = parser.parse_known_args()
+    if args.attach is not None:
+        import proofdaemon
+        links = proofdaemon.remote_links(proofdaemon.parse_address(args.attach or str(proofdaemon.API_PORT)))
+        link = links[0]
+    app = QApplication(sys.argv[:1]+qtargs)
     welcome = Welcome()
     welcome.exec()
-    main = Main()
+    welcome.probe.join()
+    main = Main(welcome.setPoint)
     qtRectangle = main.frameGeometry()
     centerPoint = QDesktopWidget().availableGeometry().center()
     qtRectangle.moveCenter(centerPoint)
@@ -0,0 +1,88 @@
+# prooflog - on-disk log of a proofing run
+# (c) 2022, 2024 - Jabez McClelland jabezmcc@gmail.com
+#
+# The run is streamed to disk by a Recorder as it goes (an append-only CSV,
+# flushed every few samples), so a crash loses at most a few samples and
+# memory doesn't grow with the run.  The spreadsheet is made from the CSV by
+# export_xlsx when the run is saved.  Only the standard library is needed
+# (xlsxwriter just for the export), so the headless logger can use it too.
+#
+import csv
+import datetime as dt
+import os
+import time
+
+
+class Recorder:
+    # Append-only CSV log of a run, temperatures in C, with the lamp relay's
+    # state (1/0, blank if unknown) at each sample.  Rows are flushed and
+    # fsync'ed every `flush_every` samples or `flush_interval` seconds,
+    # whichever comes first, and on close.
+    def __init__(self, path, flush_every=10, flush_interval=30.):
+        self.path = path
+        self.flush_every = flush_every
+        self.flush_interval = flush_interval
+        self.f = open(path, 'w', newline='')
+        self.writer = csv.writer(self.f)
+        self.writer.writerow(['Time', 'Temperature (C)', 'Relay'])
+        self.count = 0
+        self.flush()
+
+    def write(self, stamp, temp, relay=None):
+        self.writer.writerow([stamp.isoformat(sep=' ', timespec='milliseconds'), '{:.2f}'.format(temp),
+                              '' if relay is None else int(relay)])
+        self.count += 1
+        self.pending += 1
+        if self.pending >= self.flush_every or time.monotonic() - self.flushed > self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        self.f.flush()
+        os.fsync(self.f.fileno())
+        self.pending = 0
+        self.flushed = time.monotonic()
+
+    def close(self):
+        if self.f.closed:
+            return
+        self.flush()
+        self.f.close()
+
+
+def read_log(path):
+    # yields (datetime, temperature in C, relay on or None) from a Recorder
+    # CSV.  A run that crashed can end in a partial row, which is skipped;
+    # logs from before the relay column have None for it.
+    with open(path, newline='') as f:
+        rows = csv.reader(f)
+        next(rows, None)
+        for row in rows:
+            try:
+                relay = bool(int(row[2])) if len(row) > 2 and row[2] else None
+                yield dt.datetime.fromisoformat(row[0]), float(row[1]), relay
+            except (IndexError, ValueError):
+                continue
+
+
+def export_xlsx(csv_path, xlsx_path, fahrenheit=False):
+    # writes a Recorder CSV out as a spreadsheet; returns the number of rows
+    import xlsxwriter  # only needed when saving
+    wb = xlsxwriter.Workbook(xlsx_path, {'constant_memory': True})
+    timefmt = wb.add_format({'num_format': 'mmm d yyyy hh:mm:ss'})
+    ws = wb.add_worksheet()
+    ws.set_column(0, 0, 20)
+    ws.set_column(1, 2, 15)
+    ws.write(0, 0, 'Time')
+    ws.write(0, 1, 'Temperature, \xB0F' if fahrenheit else 'Temperature, \xB0C')
+    ws.write(0, 2, 'Lamp')
+    count = 0
+    for stamp, temp, relay in read_log(csv_path):
+        if fahrenheit:
+            temp = temp*9./5. + 32.
+        count += 1
+        ws.write(count, 0, stamp, timefmt)
+        ws.write(count, 1, round(temp, 2))
+        if relay is not None:
+            ws.write(count, 2, 'on' if relay else 'off')
+    wb.close()
+    return count
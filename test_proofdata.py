@@ -0,0 +1,37 @@
+import datetime as dt
+
+import numpy as np
+
+from proofdata import FANOUT, SampleStore
+
+
+def make_store(n, capacity=None):
+    store = SampleStore(capacity)
+    start = dt.datetime(2024, 6, 8)
+    for i in range(n):
+        store.append(start + dt.timedelta(seconds=i), 27. + np.sin(i/50.) + (5. if i == 3333 else 0.))
+    return store
+
+
+def test_decimated_keeps_the_outline():
+    store = make_store(5000)
+    for points in (1, 2, FANOUT - 1, FANOUT, 100, 1000):
+        times, temps = store.decimated(points=points)
+        assert 0 < len(temps) <= max(points, FANOUT)*2*FANOUT + 2
+        assert temps.max() == store.temps().max()  # the spike survives
+        assert temps.min() == store.temps().min()
+        assert np.all(np.diff(times.astype(np.int64)) > 0)
+
+
+def test_decimated_short_window():
+    store = make_store(5000)
+    start, stop = store.times()[1000], store.times()[1010]
+    times, temps = store.decimated(start, stop, points=2)
+    assert times[0] <= start and times[-1] >= stop
+
+
+def test_decimated_after_the_ring_moves_on():
+    store = make_store(5000, capacity=1000)
+    times, temps = store.decimated(points=3)
+    assert temps.max() == store.temps().max()
+    assert times[-1] == store.times()[-1]